@@ -0,0 +1,127 @@
+"""
+Asyncio access to the worksheets.
+
+gspread is blocking, so every call here runs the matching WorksheetRegistry
+or CachedWorksheet call on a worker thread with asyncio.to_thread. Caching,
+write-through, rate limiting and retries work exactly as for the
+terminal app, and a coroutine can overlap several sheet calls with
+asyncio.gather instead of making them one after another. The number of
+calls in flight is capped at the HTTP connection pool size.
+"""
+import asyncio
+
+from sheets import HTTP_POOL_SIZE, PAGE_SIZE, iter_pages
+
+
+class AsyncWorksheet:
+    """Coroutine versions of the worksheet calls the app makes"""
+    def __init__(self, worksheet, limiter):
+        self.worksheet = worksheet
+        self.limiter = limiter
+
+    @property
+    def title(self):
+        return self.worksheet.title
+
+    async def _call(self, method, *args, **kwargs):
+        async with self.limiter:
+            return await asyncio.to_thread(
+                getattr(self.worksheet, method), *args, **kwargs
+            )
+
+    async def get_all_values(self):
+        return await self._call("get_all_values")
+
+    async def get_all_records(self):
+        return await self._call("get_all_records")
+
+    async def get(self, range_name):
+        return await self._call("get", range_name)
+
+    async def row_number(self, key, column=1):
+        return await self._call("row_number", key, column)
+
+    async def cached_row(self, row_number):
+        return await self._call("cached_row", row_number)
+
+    async def refresh_tail(self):
+        return await self._call("refresh_tail")
+
+    async def append_row(self, row, **kwargs):
+        return await self._call("append_row", row, **kwargs)
+
+    async def append_rows(self, rows, **kwargs):
+        return await self._call("append_rows", rows, **kwargs)
+
+    async def update_cell(self, row, col, value):
+        return await self._call("update_cell", row, col, value)
+
+    async def batch_update(self, data, **kwargs):
+        return await self._call("batch_update", data, **kwargs)
+
+    async def iter_pages(self, page_size=PAGE_SIZE, first_row=2,
+                         width=None):
+        """Async generator over sheets.iter_pages, a range read a page"""
+        pages = iter_pages(self.worksheet, page_size, first_row, width)
+        while True:
+            async with self.limiter:
+                page = await asyncio.to_thread(next, pages, None)
+            if page is None:
+                return
+            yield page
+
+    def batch(self):
+        """A CellBatch on the wrapped worksheet, send it with flush()"""
+        return self.worksheet.batch()
+
+    async def flush(self, batch):
+        """Send a CellBatch made by batch()"""
+        async with self.limiter:
+            return await asyncio.to_thread(batch.flush)
+
+
+class AsyncSheets:
+    """
+    The async face of a WorksheetRegistry and, optionally, the
+    AdministrationLogWriter that goes with it.
+    """
+    def __init__(self, registry, log_writer=None,
+                 max_concurrency=HTTP_POOL_SIZE):
+        self.registry = registry
+        self.log_writer = log_writer
+        self.limiter = asyncio.Semaphore(max_concurrency)
+        self._worksheets = {}
+
+    async def worksheet(self, name):
+        """The worksheet, opened on a worker thread the first time"""
+        worksheet = self._worksheets.get(name)
+        if worksheet is None:
+            async with self.limiter:
+                handle = await asyncio.to_thread(self.registry.__getitem__,
+                                                 name)
+            worksheet = self._worksheets.setdefault(
+                name, AsyncWorksheet(handle, self.limiter)
+            )
+        return worksheet
+
+    async def fetch_all(self, names):
+        """Download several sheets at once, returns {name: rows}"""
+        async def fetch(name):
+            worksheet = await self.worksheet(name)
+            return await worksheet.get_all_values()
+
+        names = list(names)
+        values = await asyncio.gather(*(fetch(name) for name in names))
+        return dict(zip(names, values))
+
+    async def write_log(self, row):
+        """Journal an administration log row, see AdministrationLogWriter"""
+        await asyncio.to_thread(self.log_writer.write, row)
+
+    async def write_log_rows(self, rows):
+        await asyncio.to_thread(self.log_writer.write_rows, rows)
+
+    async def flush_log(self):
+        """Send the queued log rows now, False if Google refused them"""
+        async with self.limiter:
+            return await asyncio.to_thread(self.log_writer.flush)
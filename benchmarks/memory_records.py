@@ -0,0 +1,119 @@
+"""
+Memory taken by inventory and patient rows in each record layout.
+
+Compares one plain dict-backed object per row (the layout the record
+classes used before __slots__), the slots-based record classes and the
+column-oriented InventoryTable.
+
+    python3 benchmarks/memory_records.py [rows]
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MEDAPP_BACKEND", "memory")
+
+from run import InventoryTable, MedicationInventory, PatientInformation  # noqa
+
+DEFAULT_ROWS = 100000
+
+
+class DictMedication:
+    def __init__(
+        self, medication_name, strength, form, quantity_in_stock,
+        reorder_level, last_ordered_date, in_stock
+    ):
+        self.medication_name = medication_name
+        self.strength = strength
+        self.form = form
+        self.quantity_in_stock = int(quantity_in_stock)
+        self.reorder_level = int(reorder_level)
+        self.last_ordered_date = last_ordered_date
+        self.in_stock = in_stock
+
+
+class DictPatient:
+    def __init__(
+        self, patient_id, patient_name, patient_surname, patient_birthdate,
+        room_bed_number
+    ):
+        self.patient_id = patient_id
+        self.patient_name = patient_name
+        self.patient_surname = patient_surname
+        self.patient_birthdate = patient_birthdate
+        self.room_bed_number = room_bed_number
+
+
+def inventory_rows(count):
+    return [
+        [
+            f"Medication {i}", f"{i % 50 + 1}mg", "Tablet",
+            str(1000 + i % 5000), str(300 + i % 700), "01-01-2024", "TRUE"
+        ]
+        for i in range(count)
+    ]
+
+
+def patient_rows(count):
+    return [
+        [str(i), f"Name{i}", f"Surname{i}", "01-01-1950", f"R{i % 900}"]
+        for i in range(count)
+    ]
+
+
+def measure(build, rows):
+    """Bytes still allocated by build(rows), not counting rows itself"""
+    tracemalloc.start()
+    records = build(rows)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return size
+
+
+def medications_with(record_class):
+    def build(rows):
+        return [
+            record_class(
+                row[0], row[1], row[2], row[3], row[4], row[5],
+                row[6] == 'TRUE'
+            )
+            for row in rows
+        ]
+    return build
+
+
+def patients_with(record_class):
+    def build(rows):
+        return [record_class(*row) for row in rows]
+    return build
+
+
+def report(title, rows, layouts):
+    print(f"\n{title} ({len(rows)} rows)")
+    baseline = None
+    for name, build in layouts:
+        size = measure(build, rows)
+        baseline = baseline or size
+        print(
+            f"  {name:<22}{size / 1024 / 1024:8.1f} MiB"
+            f"{size / len(rows):8.0f} B/row{size / baseline:8.0%}"
+        )
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ROWS
+    report("Inventory", inventory_rows(count), [
+        ("dict-backed objects", medications_with(DictMedication)),
+        ("__slots__ objects", medications_with(MedicationInventory)),
+        ("InventoryTable", InventoryTable.from_values),
+    ])
+    report("Patients", patient_rows(count), [
+        ("dict-backed objects", patients_with(DictPatient)),
+        ("__slots__ objects", patients_with(PatientInformation)),
+    ])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Full-text search over the guidelines, from a memory-mapped file.
+
+The guidelines sheet is written once to guidelines.corpus: the text of
+every field, an inverted index from each word to the places it occurs
+(guideline, field and word position), and a sorted term table to find a
+word's postings by binary search. Searching maps the file and reads only
+the postings of the query's words and the text of the guidelines that
+match, so "respiratory depression" is found across every field without
+building an object per guideline or per word. The file is rebuilt when
+the guidelines sheet changes.
+
+File layout, all integers in native byte order:
+
+    header      magic, sheet fingerprint, counts and section offsets
+    bounds      Q * (guidelines * fields + 1), byte offsets into text
+    text        every field, UTF-8, one after another
+    terms       (Q string offset, I length, Q posting offset, I count)
+                per word, sorted by the word's UTF-8 bytes
+    strings     the words
+    postings    I triples of (guideline, field, position)
+"""
+import hashlib
+import json
+import mmap
+import operator
+import os
+import re
+import struct
+import sys
+import tempfile
+from array import array
+from itertools import repeat
+
+GUIDELINE_CORPUS_FILE = 'guidelines.corpus'
+GUIDELINE_FIELDS = 7
+
+MAGIC = b'MEDGLC01'
+HEADER = struct.Struct('<8s20sIIQQQQQQ')
+TERM = struct.Struct('<QIQI')
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def words(text):
+    """Lower-case words of text, the unit the index is built on"""
+    return _WORD_RE.findall(str(text).lower())
+
+
+def fingerprint(rows):
+    """Identifies the sheet contents the corpus was built from"""
+    digest = hashlib.sha1(MAGIC + sys.byteorder.encode())
+    for row in rows:
+        digest.update(json.dumps(list(row)).encode('utf-8'))
+    return digest.digest()
+
+
+def _pad(length):
+    return b'\0' * (-length % 8)
+
+
+def build_corpus(rows, path=GUIDELINE_CORPUS_FILE):
+    """Write the corpus file for the guidelines sheet rows (no header)"""
+    bounds = array('Q', [0])
+    texts = []
+    postings = {}
+    size = 0
+    for doc, row in enumerate(rows):
+        row = (list(row) + [''] * GUIDELINE_FIELDS)[:GUIDELINE_FIELDS]
+        for field, value in enumerate(row):
+            encoded = str(value).encode('utf-8')
+            texts.append(encoded)
+            size += len(encoded)
+            bounds.append(size)
+            for position, word in enumerate(words(value)):
+                postings.setdefault(word, array('I')).extend(
+                    (doc, field, position)
+                )
+    text = b''.join(texts)
+
+    terms = sorted(postings, key=lambda word: word.encode('utf-8'))
+    strings = bytearray()
+    entries = bytearray()
+    posting_data = array('I')
+    for word in terms:
+        encoded = word.encode('utf-8')
+        entries += TERM.pack(
+            len(strings), len(encoded), len(posting_data),
+            len(postings[word]) // 3
+        )
+        strings += encoded
+        posting_data.extend(postings[word])
+
+    sections = [
+        bounds.tobytes(), text, bytes(entries), bytes(strings),
+        posting_data.tobytes()
+    ]
+    offsets = []
+    position = HEADER.size
+    for section in sections:
+        offsets.append(position)
+        position += len(section) + len(_pad(len(section)))
+    header = HEADER.pack(
+        MAGIC, fingerprint(rows), len(rows), GUIDELINE_FIELDS, len(terms),
+        *offsets
+    )
+
+    # A unique temporary name, as API requests may rebuild at once
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp'
+    )
+    with os.fdopen(fd, 'wb') as out:
+        out.write(header)
+        for section in sections:
+            out.write(section)
+            out.write(_pad(len(section)))
+    os.replace(tmp_path, path)
+
+
+class GuidelineCorpus:
+    """A memory-mapped corpus file, see the module docstring"""
+    def __init__(self, path=GUIDELINE_CORPUS_FILE):
+        self.path = path
+        with open(path, 'rb') as source:
+            self._map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, self.fingerprint, self.doc_count, self.field_count,
+             self.term_count, bounds, self._text, self._terms,
+             self._strings, self._postings) = HEADER.unpack_from(self._map)
+        except struct.error:
+            self._map.close()
+            raise ValueError(f"{path} is not a guidelines corpus")
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a guidelines corpus")
+        count = self.doc_count * self.field_count + 1
+        self._bounds = memoryview(self._map)[bounds:bounds + 8 * count] \
+            .cast('Q')
+
+    @classmethod
+    def for_rows(cls, rows, path=GUIDELINE_CORPUS_FILE):
+        """Open the corpus for these rows, building it if it's stale"""
+        try:
+            corpus = cls(path)
+        except (OSError, ValueError):
+            corpus = None
+        if corpus is not None and corpus.fingerprint == fingerprint(rows):
+            return corpus
+        if corpus is not None:
+            corpus.close()
+        build_corpus(rows, path)
+        return cls(path)
+
+    def close(self):
+        self._bounds.release()
+        self._map.close()
+
+    def __len__(self):
+        return self.doc_count
+
+    def field(self, doc, field):
+        index = doc * self.field_count + field
+        start = self._text + self._bounds[index]
+        end = self._text + self._bounds[index + 1]
+        return self._map[start:end].decode('utf-8')
+
+    def row(self, doc):
+        """Every field of one guideline, in sheet column order"""
+        return [self.field(doc, field) for field in range(self.field_count)]
+
+    def _term(self, index):
+        offset, length, postings, count = TERM.unpack_from(
+            self._map, self._terms + index * TERM.size
+        )
+        start = self._strings + offset
+        return self._map[start:start + length], postings, count
+
+    def postings(self, word):
+        """(guideline, field, position) triples for a word, flat"""
+        key = word.encode('utf-8')
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.term_count:
+            return ()
+        term, postings, count = self._term(low)
+        if term != key:
+            return ()
+        start = self._postings + postings * 4
+        return memoryview(self._map)[start:start + count * 12].cast('I')
+
+    def search(self, query):
+        """
+        Guidelines containing the words of query next to each other, in
+        order, within one field. Returns (guideline, [fields]) pairs in
+        sheet order.
+        """
+        query_words = words(query)
+        if not query_words:
+            return []
+        # Start positions of the phrase, narrowed one word at a time
+        starts = None
+        for offset, word in enumerate(query_words):
+            postings = self.postings(word)
+            flat = postings.tolist() if postings else []
+            if postings:
+                postings.release()
+            found = set(zip(
+                flat[0::3], flat[1::3],
+                map(operator.sub, flat[2::3], repeat(offset))
+            ))
+            starts = found if starts is None else starts & found
+            if not starts:
+                return []
+        matches = {}
+        for doc, field, _ in starts:
+            matches.setdefault(doc, set()).add(field)
+        return [(doc, sorted(matches[doc])) for doc in sorted(matches)]
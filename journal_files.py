@@ -0,0 +1,134 @@
+"""
+Journal files owned by one process.
+
+Several copies of the app can run in the same directory, one per
+websocket connection, and any of them can be killed outright. So each
+process writes its journals to files of its own, the journal name plus
+a unique suffix, and holds an flock on each of them while it runs. The
+kernel drops the lock when the process dies, however it dies, so a
+journal whose lock can be taken has no owner left. The next process to
+look adopts its entries and deletes it. A journal without a suffix, as
+written by older versions, is adopted the same way.
+
+Journals are only ever appended to and truncated in place, never
+replaced, so the lock always covers the file other processes see.
+"""
+import fcntl
+import glob
+import json
+import logging
+import os
+import uuid
+from contextlib import contextmanager
+
+
+def _lock(journal):
+    try:
+        fcntl.flock(journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an flock on path, waiting for any other holder to let go"""
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def _still_at(path, journal):
+    """
+    True if path still names the open file. An adopter deletes a journal
+    before unlocking it, so a lock taken after that is on a dead file.
+    """
+    try:
+        return os.stat(path).st_ino == os.fstat(journal.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def open_own(base_path):
+    """Create and lock this process's journal, returns (path, file)"""
+    while True:
+        path = f"{base_path}.{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        journal = open(path, 'a+', encoding='utf-8')
+        if _lock(journal) and _still_at(path, journal):
+            return path, journal
+        journal.close()
+
+
+def orphans(base_path, own_path=None):
+    """
+    Yield (path, file) for each journal of base_path whose process is
+    gone, locked and open for reading. The caller saves the entries
+    elsewhere and then calls discard().
+    """
+    paths = [base_path] + sorted(glob.glob(glob.escape(base_path) + '.*'))
+    for path in paths:
+        if path == own_path or path.endswith('.tmp'):
+            continue
+        try:
+            journal = open(path, 'r+', encoding='utf-8')
+        except FileNotFoundError:
+            continue
+        if _lock(journal) and _still_at(path, journal):
+            yield path, journal
+        else:
+            journal.close()
+
+
+def busy(base_path, own_path=None):
+    """
+    Paths of base_path's journals that a running process holds and has
+    written entries to, so work it started is not finished yet
+    """
+    paths = [base_path] + sorted(glob.glob(glob.escape(base_path) + '.*'))
+    found = []
+    for path in paths:
+        if path == own_path or path.endswith('.tmp'):
+            continue
+        try:
+            journal = open(path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            continue
+        with journal:
+            if not _lock(journal) and os.fstat(journal.fileno()).st_size:
+                found.append(path)
+    return found
+
+
+def discard(path, journal):
+    """Delete an adopted journal, then give up its lock"""
+    os.remove(path)
+    journal.close()
+
+
+def append(journal, entries):
+    """Write entries as JSON lines and fsync them"""
+    for entry in entries:
+        journal.write(json.dumps(entry) + '\n')
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def clear(journal):
+    """Empty a journal whose entries are all done with"""
+    journal.seek(0)
+    journal.truncate()
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def entries(journal):
+    """The JSON entries of a journal, skipping damaged lines"""
+    journal.seek(0)
+    for line in journal:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            logging.error(f"Skipping damaged journal line: {line}")
@@ -0,0 +1,468 @@
+"""
+Offline-first local copy of the medication_inventory spreadsheet.
+
+LocalStore keeps every worksheet in a SQLite file and serves all reads
+from it. A write changes the local rows and is recorded in a journal in
+the same transaction. SyncWorker replays the journal to Google Sheets in
+order, retries failures with a growing delay, and flags a cell write as
+a conflict when someone else changed that cell in the meantime.
+
+Several processes can share one SQLite file. Only one of them replays
+the journal at a time, the one holding an flock on the file's
+.sync.lock, so no entry is sent twice.
+"""
+import fcntl
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from gspread.cell import Cell
+from gspread.exceptions import WorksheetNotFound
+from gspread.utils import a1_to_rowcol, rowcol_to_a1
+
+from sheets import (
+    SPREADSHEET_NAME, WORKSHEET_NAMES, cell_text, records_from_values
+)
+
+LOCAL_STORE_FILE = 'medication_inventory.sqlite3'
+SYNC_INTERVAL = 10.0
+PULL_INTERVAL = 300.0
+MAX_RETRY_DELAY = 300.0
+SYNC_LOCK_SUFFIX = '.sync.lock'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheet_rows (
+    sheet TEXT NOT NULL,
+    row_number INTEGER NOT NULL,
+    cells TEXT NOT NULL,
+    PRIMARY KEY (sheet, row_number)
+);
+CREATE TABLE IF NOT EXISTS sheets (
+    sheet TEXT PRIMARY KEY,
+    pulled_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sheet TEXT NOT NULL,
+    op TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+"""
+
+
+class LocalStore:
+    """
+    SQLite mirror of the spreadsheet. worksheet(name) hands out
+    LocalWorksheet objects that answer the same calls as gspread.
+    """
+    def __init__(self, path=LOCAL_STORE_FILE, title=SPREADSHEET_NAME):
+        self.path = path
+        self.title = title
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def has_sheet(self, name):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM sheets WHERE sheet = ?", (name,)
+            ).fetchone()
+            return row is not None
+
+    def pulled_at(self, name):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT pulled_at FROM sheets WHERE sheet = ?", (name,)
+            ).fetchone()
+            return row[0] if row else None
+
+    def worksheet(self, name):
+        if not self.has_sheet(name):
+            raise WorksheetNotFound(name)
+        return LocalWorksheet(self, name)
+
+    def load_sheet(self, name, values):
+        """Replace the local copy of a sheet with freshly pulled values"""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM sheet_rows WHERE sheet = ?", (name,))
+            self._db.executemany(
+                "INSERT INTO sheet_rows (sheet, row_number, cells) "
+                "VALUES (?, ?, ?)",
+                [
+                    (name, row_number, json.dumps(list(row)))
+                    for row_number, row in enumerate(values, start=1)
+                ]
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO sheets (sheet, pulled_at) "
+                "VALUES (?, ?)",
+                (name, time.time())
+            )
+
+    def values(self, name):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT row_number, cells FROM sheet_rows WHERE sheet = ? "
+                "ORDER BY row_number", (name,)
+            ).fetchall()
+        values = []
+        for row_number, cells in rows:
+            while len(values) < row_number - 1:
+                values.append([])
+            values.append(json.loads(cells))
+        width = max((len(row) for row in values), default=0)
+        return [row + [''] * (width - len(row)) for row in values]
+
+    def row_count(self, name):
+        """Number of the last row of a sheet"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT MAX(row_number) FROM sheet_rows WHERE sheet = ?",
+                (name,)
+            ).fetchone()[0] or 0
+
+    def rows(self, name, first_row, last_row=None):
+        """Rows first_row to last_row (1-based, inclusive, open ended
+        when last_row is None), without reading the rest of the sheet"""
+        with self._lock:
+            found = self._db.execute(
+                "SELECT row_number, cells FROM sheet_rows WHERE sheet = ? "
+                "AND row_number >= ? AND (? IS NULL OR row_number <= ?) "
+                "ORDER BY row_number",
+                (name, first_row, last_row, last_row)
+            ).fetchall()
+        rows = []
+        for row_number, cells in found:
+            while len(rows) < row_number - first_row:
+                rows.append([])
+            rows.append(json.loads(cells))
+        return rows
+
+    def _journal(self, name, op, payload):
+        self._db.execute(
+            "INSERT INTO journal (sheet, op, payload) VALUES (?, ?, ?)",
+            (name, op, json.dumps(payload))
+        )
+
+    def append_rows(self, name, rows):
+        """Append rows locally and journal them, returns the first row"""
+        rows = [[cell_text(value) for value in row] for row in rows]
+        with self._lock, self._db:
+            last = self._db.execute(
+                "SELECT MAX(row_number) FROM sheet_rows WHERE sheet = ?",
+                (name,)
+            ).fetchone()[0] or 0
+            self._db.executemany(
+                "INSERT INTO sheet_rows (sheet, row_number, cells) "
+                "VALUES (?, ?, ?)",
+                [
+                    (name, last + offset, json.dumps(row))
+                    for offset, row in enumerate(rows, start=1)
+                ]
+            )
+            self._journal(name, 'append', {"rows": rows})
+        return last + 1
+
+    def set_cells(self, name, changes):
+        """
+        Apply (row, col, value) changes locally and journal each one
+        with the value it replaced, for conflict checks during sync.
+        """
+        with self._lock, self._db:
+            for row_number, col, value in changes:
+                value = cell_text(value)
+                found = self._db.execute(
+                    "SELECT cells FROM sheet_rows "
+                    "WHERE sheet = ? AND row_number = ?", (name, row_number)
+                ).fetchone()
+                cells = json.loads(found[0]) if found else []
+                cells.extend([''] * (col - len(cells)))
+                old = cells[col - 1]
+                cells[col - 1] = value
+                self._db.execute(
+                    "INSERT OR REPLACE INTO sheet_rows "
+                    "(sheet, row_number, cells) VALUES (?, ?, ?)",
+                    (name, row_number, json.dumps(cells))
+                )
+                self._journal(name, 'cell', {
+                    "row": row_number, "col": col, "old": old, "new": value
+                })
+
+    def pending(self, name=None):
+        """Journal entries not yet replayed, oldest first"""
+        query = (
+            "SELECT id, sheet, op, payload, attempts FROM journal "
+            "WHERE status = 'pending'"
+        )
+        args = ()
+        if name is not None:
+            query += " AND sheet = ?"
+            args = (name,)
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY id", args).fetchall()
+        return [
+            (entry_id, sheet, op, json.loads(payload), attempts)
+            for entry_id, sheet, op, payload, attempts in rows
+        ]
+
+    def conflicts(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, sheet, op, payload, error FROM journal "
+                "WHERE status = 'conflict' ORDER BY id"
+            ).fetchall()
+        return [
+            (entry_id, sheet, op, json.loads(payload), error)
+            for entry_id, sheet, op, payload, error in rows
+        ]
+
+    def mark_done(self, entry_id):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM journal WHERE id = ?", (entry_id,))
+
+    def mark_failed(self, entry_id, error):
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE journal SET attempts = attempts + 1, error = ? "
+                "WHERE id = ?", (error, entry_id)
+            )
+
+    def mark_conflict(self, entry_id, error):
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE journal SET status = 'conflict', error = ? "
+                "WHERE id = ?", (error, entry_id)
+            )
+
+
+class LocalWorksheet:
+    """One sheet of a LocalStore, with the gspread calls the app makes"""
+    def __init__(self, store, title):
+        self.store = store
+        self.title = title
+
+    @property
+    def row_count(self):
+        return self.store.row_count(self.title)
+
+    def get_all_values(self):
+        return self.store.values(self.title)
+
+    def get_all_records(self):
+        return records_from_values(self.get_all_values())
+
+    def get(self, range_name, **kwargs):
+        """Rows of an A1 range such as 'A5:G' or 'A5:G9'"""
+        start, _, end = range_name.split('!')[-1].partition(':')
+        first_row, first_col = a1_to_rowcol(start)
+        end = end or start
+        if end.isalpha():
+            last_row, last_col = None, a1_to_rowcol(end + '1')[1]
+        else:
+            last_row, last_col = a1_to_rowcol(end)
+        rows = self.store.rows(self.title, first_row, last_row)
+        return [row[first_col - 1:last_col] for row in rows]
+
+    def cell(self, row, col, **kwargs):
+        values = self.get_all_values()
+        try:
+            value = values[row - 1][col - 1]
+        except IndexError:
+            value = None
+        return Cell(row, col, value)
+
+    def _appended(self, first_row, rows):
+        width = max((len(row) for row in rows), default=1)
+        last = rowcol_to_a1(first_row + len(rows) - 1, max(width, 1))
+        return {"updates": {
+            "updatedRange": f"'{self.title}'!A{first_row}:{last}"
+        }}
+
+    def append_row(self, values, **kwargs):
+        first_row = self.store.append_rows(self.title, [values])
+        return self._appended(first_row, [values])
+
+    def append_rows(self, values, **kwargs):
+        values = list(values)
+        first_row = self.store.append_rows(self.title, values)
+        return self._appended(first_row, values)
+
+    def update_cell(self, row, col, value):
+        self.store.set_cells(self.title, [(row, col, value)])
+        return {"updatedCells": 1}
+
+    def update(self, values=None, range_name=None, **kwargs):
+        if isinstance(values, str) and range_name is not None:
+            values, range_name = range_name, values
+        if not isinstance(values, (list, tuple)):
+            values = [[values]]
+        return self.batch_update([{"range": range_name, "values": values}])
+
+    def batch_update(self, data, **kwargs):
+        changes = []
+        for change in data:
+            first_row, first_col = a1_to_rowcol(
+                change["range"].split('!')[-1].split(':')[0]
+            )
+            for r, row in enumerate(change["values"]):
+                for c, value in enumerate(row):
+                    changes.append((first_row + r, first_col + c, value))
+        self.store.set_cells(self.title, changes)
+        return {"totalUpdatedCells": len(changes)}
+
+
+class SyncWorker:
+    """
+    Replays the LocalStore journal to the real spreadsheet and pulls
+    fresh copies of sheets that have nothing waiting to be sent.
+
+    spreadsheet_factory returns a gspread Spreadsheet, or anything with
+    the same worksheet() call such as memory_sheets.MemorySpreadsheet.
+    """
+    def __init__(
+        self, store, spreadsheet_factory, worksheet_names=WORKSHEET_NAMES,
+        interval=SYNC_INTERVAL, pull_interval=PULL_INTERVAL
+    ):
+        self.store = store
+        self.spreadsheet_factory = spreadsheet_factory
+        self.worksheet_names = tuple(worksheet_names)
+        self.interval = interval
+        self.pull_interval = pull_interval
+        self.failures = 0
+        self._spreadsheet = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._sync_lock = threading.Lock()
+        self.lock_path = store.path + SYNC_LOCK_SUFFIX
+
+    def _remote(self, name):
+        if self._spreadsheet is None:
+            self._spreadsheet = self.spreadsheet_factory()
+        return self._spreadsheet.worksheet(name)
+
+    def pull(self, name):
+        """Refresh the local copy, unless local writes are still queued"""
+        if self.store.pending(name):
+            return False
+        self.store.load_sheet(name, self._remote(name).get_all_values())
+        return True
+
+    def pull_missing(self):
+        """Fetch every sheet that has never been pulled"""
+        for name in self.worksheet_names:
+            if not self.store.has_sheet(name):
+                self.pull(name)
+
+    def _apply(self, sheet, op, payload):
+        """Send one journal entry, returns a conflict message or None"""
+        worksheet = self._remote(sheet)
+        if op == 'append':
+            worksheet.append_rows(payload["rows"])
+            return None
+        remote_cell = worksheet.cell(payload["row"], payload["col"])
+        remote = cell_text(remote_cell.value)
+        if remote == payload["new"]:
+            return None
+        if remote != payload["old"]:
+            return (
+                f"{sheet} {rowcol_to_a1(payload['row'], payload['col'])} "
+                f"is '{remote}' on the sheet, expected '{payload['old']}'"
+            )
+        worksheet.update_cell(payload["row"], payload["col"], payload["new"])
+        return None
+
+    def push(self, wait=False):
+        """
+        Replay pending journal entries in order. Stops at the first
+        failure so later writes never overtake earlier ones.
+        Returns True when the journal was fully replayed, False after a
+        failure or, unless wait is set, when another process sharing the
+        store is replaying it already.
+        """
+        with self._sync_lock, open(self.lock_path, 'a') as lock_file:
+            flags = fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_file.fileno(), flags)
+            except BlockingIOError:
+                return False
+            # Read under the lock, after any other process has finished
+            for entry_id, sheet, op, payload, _ in self.store.pending():
+                try:
+                    conflict = self._apply(sheet, op, payload)
+                except Exception as e:
+                    self.store.mark_failed(entry_id, str(e))
+                    self.failures += 1
+                    logging.error(f"Sync of journal entry {entry_id} "
+                                  f"failed: {str(e)}")
+                    return False
+                if conflict:
+                    self.store.mark_conflict(entry_id, conflict)
+                    logging.error(f"Sync conflict: {conflict}")
+                else:
+                    self.store.mark_done(entry_id)
+            self.failures = 0
+            return True
+
+    def sync(self):
+        """Push the journal, then pull sheets that have gone stale"""
+        if not self.push():
+            return False
+        now = time.time()
+        for name in self.worksheet_names:
+            pulled_at = self.store.pulled_at(name)
+            if pulled_at is None or now - pulled_at >= self.pull_interval:
+                try:
+                    self.pull(name)
+                except Exception as e:
+                    logging.error(f"Could not refresh {name}: {str(e)}")
+                    return False
+        return True
+
+    def _delay(self):
+        if not self.failures:
+            return self.interval
+        return min(MAX_RETRY_DELAY, self.interval * 2 ** self.failures)
+
+    def _run(self):
+        while not self._stop.wait(self._delay()):
+            try:
+                self.sync()
+            except Exception as e:
+                self.failures += 1
+                logging.error(f"Sync failed: {str(e)}")
+
+    def start(self):
+        """Pull anything missing locally, then sync in the background"""
+        self.pull_missing()
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='sheet-sync', daemon=True
+            )
+            self._thread.start()
+
+    def stop(self, timeout=30):
+        """Stop the background thread and try one last push"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        try:
+            self.push(wait=True)
+        except Exception as e:
+            logging.error(f"Final sync failed: {str(e)}")
+        left = len(self.store.pending())
+        if left:
+            logging.error(f"{left} local changes not yet synced to "
+                          f"Google Sheets, they are kept in {self.store.path}")
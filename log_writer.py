@@ -0,0 +1,175 @@
+"""
+Background writer for the medication administration log.
+
+Log rows are written to a local journal file first and then sent to the
+medication_administration_logs worksheet in batches with append_rows, so
+the nurse doesn't wait on Google after confirming a dose. Rows stay in
+the journal until Google has accepted them, and any left over from a
+crash are sent again on the next start.
+
+Each process has a journal file of its own, see journal_files.py, and
+only takes over the journals of processes that are gone. The journal is
+append-only: a sent batch is recorded as a {"sent": n} line, meaning
+the first n unsent rows, and the file is emptied once nothing is left.
+"""
+import logging
+import threading
+
+import journal_files
+
+LOG_JOURNAL_FILE = 'administration_log.journal'
+FLUSH_INTERVAL = 5.0
+FLUSH_SIZE = 20
+
+
+def unsent_rows(entries):
+    """The rows of a log journal not yet marked as sent"""
+    rows = []
+    sent = 0
+    for entry in entries:
+        if isinstance(entry, dict):
+            sent += entry.get("sent", 0)
+        else:
+            rows.append(entry)
+    return rows[sent:]
+
+
+class AdministrationLogWriter:
+    """
+    Queues log rows and flushes them every flush_interval seconds, or
+    as soon as batch_size rows are waiting.
+
+    worksheet_factory is called on each flush to get the log worksheet,
+    so the worksheet is only opened once there is something to write.
+    """
+    def __init__(
+        self, worksheet_factory, journal_path=LOG_JOURNAL_FILE,
+        flush_interval=FLUSH_INTERVAL, batch_size=FLUSH_SIZE
+    ):
+        self.worksheet_factory = worksheet_factory
+        self.journal_base = journal_path
+        self.journal_path = None
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending = []
+        self._journal = None
+        self._lock = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closing = False
+
+    def _open_journal(self):
+        """
+        Create this process's journal on first use and take over the
+        unsent rows of any process that stopped without sending them.
+        Called with the lock held.
+        """
+        if self._journal is not None:
+            return
+        self.journal_path, self._journal = journal_files.open_own(
+            self.journal_base
+        )
+        adopted = 0
+        for path, orphan in journal_files.orphans(
+            self.journal_base, self.journal_path
+        ):
+            rows = unsent_rows(journal_files.entries(orphan))
+            journal_files.append(self._journal, rows)
+            self._pending.extend(rows)
+            journal_files.discard(path, orphan)
+            adopted += len(rows)
+        if adopted:
+            logging.info(f"Recovered {adopted} unsent log rows")
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def start(self):
+        """Start the background flush thread"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._open_journal()
+            self._closing = False
+            self._thread = threading.Thread(
+                target=self._run, name='log-writer', daemon=True
+            )
+            self._thread.start()
+
+    def write(self, row):
+        """Journal a log row and queue it for the next flush"""
+        self.write_rows([row])
+
+    def write_rows(self, rows):
+        """Journal several log rows with one fsync and queue them"""
+        rows = [[str(value) for value in row] for row in rows]
+        with self._lock:
+            self._open_journal()
+            journal_files.append(self._journal, rows)
+            self._pending.extend(rows)
+            if len(self._pending) >= self.batch_size:
+                self._lock.notify()
+
+    def flush(self):
+        """
+        Send every queued row in one append_rows call.
+        Returns False if Google refused them, they stay queued.
+        """
+        with self._flush_lock:
+            with self._lock:
+                self._open_journal()
+                batch = list(self._pending)
+            if not batch:
+                return True
+            try:
+                self.worksheet_factory().append_rows(batch)
+            except Exception as e:
+                logging.error(
+                    f"Could not send {len(batch)} log rows, "
+                    f"will retry: {str(e)}"
+                )
+                return False
+            with self._lock:
+                del self._pending[:len(batch)]
+                if self._pending:
+                    journal_files.append(
+                        self._journal, [{"sent": len(batch)}]
+                    )
+                else:
+                    journal_files.clear(self._journal)
+            return True
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._closing \
+                        and len(self._pending) < self.batch_size:
+                    self._lock.wait(self.flush_interval)
+                closing = self._closing
+            self.flush()
+            if closing:
+                return
+
+    def close(self, timeout=30):
+        """Stop the thread after a last flush of everything queued"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+            self._closing = True
+            self._lock.notify()
+        if thread is not None:
+            thread.join(timeout)
+        else:
+            self.flush()
+        with self._lock:
+            if self._pending:
+                logging.error(
+                    f"{len(self._pending)} log rows not sent, they are "
+                    f"kept in {self.journal_path}"
+                )
+            elif self._journal is not None \
+                    and not (thread is not None and thread.is_alive()):
+                journal_files.discard(self.journal_path, self._journal)
+                self._journal = None
@@ -0,0 +1,179 @@
+"""
+In-memory stand-in for the parts of gspread the app uses.
+
+MemoryClient, MemorySpreadsheet and MemoryWorksheet answer the same calls
+as their gspread counterparts without any network access, so the app,
+the local store sync and benchmarks can run against them.
+"""
+import threading
+
+from gspread.cell import Cell
+from gspread.exceptions import SpreadsheetNotFound, WorksheetNotFound
+from gspread.utils import a1_to_rowcol, rowcol_to_a1
+
+from sheets import cell_text, records_from_values
+
+
+def _a1_bounds(range_name):
+    """(first_row, first_col, last_row, last_col) of an A1 range, last
+    row None when the range is open ended like 'A5:G'"""
+    range_name = range_name.split('!')[-1]
+    if ':' not in range_name:
+        row, col = a1_to_rowcol(range_name)
+        return row, col, row, col
+    start, end = range_name.split(':')
+    first_row, first_col = a1_to_rowcol(start)
+    if end.isalpha():
+        _, last_col = a1_to_rowcol(end + '1')
+        return first_row, first_col, None, last_col
+    last_row, last_col = a1_to_rowcol(end)
+    return first_row, first_col, last_row, last_col
+
+
+class MemoryWorksheet:
+    """A worksheet held as a list of rows of strings"""
+    def __init__(self, title, values=None):
+        self.title = title
+        self._rows = [[cell_text(v) for v in row] for row in values or []]
+        self._lock = threading.RLock()
+        self.calls = 0
+
+    @property
+    def row_count(self):
+        return len(self._rows)
+
+    def _width(self):
+        return max((len(row) for row in self._rows), default=0)
+
+    def get_all_values(self):
+        with self._lock:
+            self.calls += 1
+            width = self._width()
+            return [row + [''] * (width - len(row)) for row in self._rows]
+
+    def get_all_records(self):
+        return records_from_values(self.get_all_values())
+
+    def get(self, range_name=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+            if range_name is None:
+                return [list(row) for row in self._rows]
+            first_row, first_col, last_row, last_col = _a1_bounds(range_name)
+            if last_row is None:
+                last_row = len(self._rows)
+            rows = []
+            for row in self._rows[first_row - 1:last_row]:
+                rows.append(list(row[first_col - 1:last_col]))
+            while rows and not any(rows[-1]):
+                rows.pop()
+            return rows
+
+    def cell(self, row, col, **kwargs):
+        with self._lock:
+            self.calls += 1
+            try:
+                value = self._rows[row - 1][col - 1]
+            except IndexError:
+                value = None
+            return Cell(row, col, value)
+
+    def _set(self, row, col, value):
+        while len(self._rows) < row:
+            self._rows.append([])
+        cells = self._rows[row - 1]
+        cells.extend([''] * (col - len(cells)))
+        cells[col - 1] = cell_text(value)
+
+    def _append(self, rows):
+        first_row = len(self._rows) + 1
+        for row in rows:
+            self._rows.append([cell_text(v) for v in row])
+        width = max((len(row) for row in rows), default=1)
+        updated_range = (
+            f"'{self.title}'!A{first_row}:"
+            f"{rowcol_to_a1(len(self._rows), max(width, 1))}"
+        )
+        return {"updates": {"updatedRange": updated_range}}
+
+    def append_row(self, values, **kwargs):
+        with self._lock:
+            self.calls += 1
+            return self._append([values])
+
+    def append_rows(self, values, **kwargs):
+        with self._lock:
+            self.calls += 1
+            return self._append(list(values))
+
+    def update_cell(self, row, col, value):
+        with self._lock:
+            self.calls += 1
+            self._set(row, col, value)
+            return {"updatedCells": 1}
+
+    def update(self, values=None, range_name=None, **kwargs):
+        # gspread 6 still accepts the old (range_name, values) order
+        if isinstance(values, str) and range_name is not None:
+            values, range_name = range_name, values
+        if not isinstance(values, (list, tuple)):
+            values = [[values]]
+        with self._lock:
+            self.calls += 1
+            first_row, first_col, _, _ = _a1_bounds(range_name or 'A1')
+            for r, row in enumerate(values):
+                for c, value in enumerate(row):
+                    self._set(first_row + r, first_col + c, value)
+            return {"updatedRange": range_name}
+
+    def batch_update(self, data, **kwargs):
+        with self._lock:
+            self.calls += 1
+            for change in data:
+                first_row, first_col, _, _ = _a1_bounds(change["range"])
+                for r, row in enumerate(change["values"]):
+                    for c, value in enumerate(row):
+                        self._set(first_row + r, first_col + c, value)
+            return {"totalUpdatedCells": len(data)}
+
+
+class MemorySpreadsheet:
+    """A named set of MemoryWorksheet objects"""
+    def __init__(self, title, sheets=None):
+        self.title = title
+        self._worksheets = {}
+        for name, values in (sheets or {}).items():
+            self.add_worksheet(name, values)
+
+    def add_worksheet(self, title, values=None):
+        worksheet = MemoryWorksheet(title, values)
+        self._worksheets[title] = worksheet
+        return worksheet
+
+    def worksheet(self, title):
+        try:
+            return self._worksheets[title]
+        except KeyError:
+            raise WorksheetNotFound(title)
+
+    def worksheets(self):
+        return list(self._worksheets.values())
+
+
+class MemoryClient:
+    """Answers client.open(name) like an authorized gspread client"""
+    def __init__(self, spreadsheets=None):
+        self._spreadsheets = {}
+        for spreadsheet in spreadsheets or []:
+            self._spreadsheets[spreadsheet.title] = spreadsheet
+
+    def create(self, title, sheets=None):
+        spreadsheet = MemorySpreadsheet(title, sheets)
+        self._spreadsheets[title] = spreadsheet
+        return spreadsheet
+
+    def open(self, title):
+        try:
+            return self._spreadsheets[title]
+        except KeyError:
+            raise SpreadsheetNotFound(title)
@@ -1,60 +1,197 @@
-import gspread
-from google.oauth2.service_account import Credentials
+import hashlib
+import json
+import logging
+import os
+import time
+
 from gspread.exceptions import SpreadsheetNotFound, WorksheetNotFound
 
+from sheets import SPREADSHEET_NAME
+from storage import GspreadBackend
+
+
 class Nurse:
+    __slots__ = ('name', 'pin')
+
     def __init__(self, name, pin):
         self.name = name
         self.pin = pin
 
-def get_nurses_from_sheet(spreadsheet_name, worksheet_name):
-    scope = [
-        "https://spreadsheets.google.com/feeds",
-        "https://www.googleapis.com/auth/drive"
-    ]
 
-    creds_path = '/workspace/animated-waffle/creds.json'
+ROSTER_CACHE_FILE = '.nurse_roster.json'
+ROSTER_TTL = 60 * 60
+# A failed login may re-read the sheet, at most once per this many
+# seconds, so a nurse added to the sheet can log in straight away.
+ROSTER_MIN_REFRESH = 60
+PIN_HASH_ITERATIONS = 20000
 
-    try:
-        creds = Credentials.from_service_account_file(creds_path, scopes=scope)
-        client = gspread.authorize(creds)
 
-        try:
-            sheet = client.open(spreadsheet_name)
-            worksheet = sheet.worksheet(worksheet_name)
-            records = worksheet.get_all_records()
-
-            nurses = [
-                Nurse(record['name'], record['pin']) for record in records
-            ]
-            return nurses
-        except SpreadsheetNotFound:
-            print(f"""
-            Error: Spreadsheet '{spreadsheet_name}' not found. Please check
-            the spreadsheet name and permissions.
-            """
-            )
-            return []
-        except WorksheetNotFound:
-            print(f"""
-            Error: Worksheet '{worksheet_name}' not found in
-            spreadsheet '{spreadsheet_name}'.
-            """
-            )
-            return []
-        except Exception as e:
-            print(f"Error accessing worksheet: {str(e)}")
-            return []
+def get_nurses_from_sheet(
+    spreadsheet_name=SPREADSHEET_NAME, worksheet_name="nurse_pin",
+    backend=None
+):
+    """
+    Retrieve nurse data from the nurse_pin worksheet. backend is any
+    storage.StorageBackend, by default Google Sheets through the shared
+    client from sheets.get_client().
+    """
+    if backend is None:
+        backend = GspreadBackend(spreadsheet_name)
 
-    except FileNotFoundError:
-        print(f"Error: Credentials file not found at {creds_path}")
+    try:
+        records = backend.worksheet(worksheet_name).get_all_records()
+        nurses = []
+        for record in records:
+            name = record.get('nurse_name', 'Unknown')
+            pin = str(record.get('nurse_pin', ''))
+            nurses.append(Nurse(name, pin))
+        return nurses
+    except SpreadsheetNotFound:
+        print(f"""
+        Error: Spreadsheet '{spreadsheet_name}' not found. Please check
+        the spreadsheet name and permissions.
+        """)
+        return []
+    except WorksheetNotFound:
+        print(f"""
+        Error: Worksheet '{worksheet_name}' not found in
+        spreadsheet '{spreadsheet_name}'.
+        """)
+        return []
+    except FileNotFoundError as e:
+        print(f"Error: Credentials file not found: {str(e)}")
         return []
     except Exception as e:
-        print(f"Error with credentials or authorization: {str(e)}")
+        print(f"Error accessing worksheet: {str(e)}")
         return []
 
-def validate_pin(pin, nurses):
+
+def validate_pin(entered_pin, nurses):
+    """
+    Validation check of the pin to gain access into the system.
+    Returns the nurse object if the PIN is valid, None otherwise.
+    """
     for nurse in nurses:
-        if nurse.pin == pin:
+        if nurse.pin == entered_pin:
+            logging.info(f"""
+            PIN validation successful for nurse: {nurse.name}
+            """)
             return nurse
-    return None
\ No newline at end of file
+    logging.info("Pin validation failed")
+    return None
+
+
+def hash_pin(pin, salt):
+    """Salted PBKDF2 hash of a PIN, as hex"""
+    return hashlib.pbkdf2_hmac(
+        'sha256', str(pin).strip().encode(), salt, PIN_HASH_ITERATIONS
+    ).hex()
+
+
+class NurseRoster:
+    """
+    Nurse names keyed by a salted hash of their PIN, so a login is one
+    hash and one dict lookup and no plain-text PIN is kept in memory or
+    on disk. With only 10000 possible PINs the hashes keep PINs out of
+    sight, they are no defence against someone with the cache file.
+
+    loader returns the Nurse list from the sheet. It is called at most
+    once per ttl seconds, and between launches the hashed roster is kept
+    in cache_path.
+    """
+    def __init__(
+        self, loader, cache_path=ROSTER_CACHE_FILE, ttl=ROSTER_TTL,
+        clock=time.time
+    ):
+        self.loader = loader
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self._clock = clock
+        self._salt = None
+        self._names = {}
+        self._loaded_at = None
+
+    def __len__(self):
+        return len(self._names)
+
+    def _expired(self):
+        return (
+            self._loaded_at is None
+            or self._clock() - self._loaded_at >= self.ttl
+        )
+
+    def _read_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return False
+        try:
+            with open(self.cache_path, encoding='utf-8') as cache:
+                data = json.load(cache)
+            self._salt = bytes.fromhex(data['salt'])
+            self._names = dict(data['nurses'])
+            self._loaded_at = float(data['loaded_at'])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"Ignoring unreadable nurse roster cache: {e}")
+            return False
+        return True
+
+    def _write_cache(self):
+        if not self.cache_path:
+            return
+        data = {
+            'salt': self._salt.hex(),
+            'loaded_at': self._loaded_at,
+            'nurses': self._names
+        }
+        tmp_path = self.cache_path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as cache:
+            json.dump(data, cache)
+        os.replace(tmp_path, self.cache_path)
+
+    def refresh(self):
+        """Re-read the sheet and hash every PIN with a fresh salt"""
+        try:
+            nurses = self.loader()
+        except Exception as e:
+            logging.error(f"Could not read the nurse roster: {e}")
+            return False
+        if not nurses:
+            return False
+        salt = os.urandom(16)
+        self._names = {
+            hash_pin(nurse.pin, salt): nurse.name for nurse in nurses
+        }
+        self._salt = salt
+        self._loaded_at = self._clock()
+        try:
+            self._write_cache()
+        except OSError as e:
+            logging.error(f"Could not save nurse roster cache: {e}")
+        return True
+
+    def load(self):
+        """
+        Make sure a roster is available, from memory, the cache file or
+        the sheet in that order. A stale roster is kept if the sheet
+        can't be read. Returns False when there is no roster at all.
+        """
+        if self._expired():
+            if self._loaded_at is None:
+                self._read_cache()
+            if self._expired() and not self.refresh():
+                logging.error("Could not refresh the nurse roster.")
+        return bool(self._names)
+
+    def lookup(self, pin):
+        """Return the Nurse with this PIN, or None"""
+        if not self.load():
+            return None
+        name = self._names.get(hash_pin(pin, self._salt))
+        if name is None and self._clock() - self._loaded_at \
+                >= ROSTER_MIN_REFRESH and self.refresh():
+            name = self._names.get(hash_pin(pin, self._salt))
+        if name is None:
+            logging.info("Pin validation failed")
+            return None
+        logging.info(f"PIN validation successful for nurse: {name}")
+        return Nurse(name, None)
@@ -0,0 +1,129 @@
+"""
+Controlled drug reconciliation.
+
+Every dose given takes stock out of the inventory sheet and adds a row
+to medication_administration_logs, and every delivery adds stock and a
+receipt row to the same log. Over any stretch of the log the stock of
+each medication should therefore move by exactly what was received
+minus what was given. A reconciliation streams the log rows added since
+the last one, sums both per medication in a single pass, and compares
+
+    stock at the last reconciliation + received - given
+
+with the stock the inventory shows now. The stock and log position are
+then saved as the starting point for the next run.
+"""
+import json
+import os
+import time
+
+RECONCILIATION_FILE = 'reconciliation.json'
+
+# Receipt rows carry this in the patient surname column
+RECEIPT_MARKER = 'STOCK RECEIVED'
+
+# medication_administration_logs columns (0-based)
+LOG_SURNAME = 1
+LOG_MEDICATION = 3
+LOG_QUANTITY = 4
+
+
+def medication_key(name):
+    return str(name).strip().lower()
+
+
+class Movements:
+    """Quantities given and received per medication, from log rows"""
+    def __init__(self):
+        self.given = {}
+        self.received = {}
+        self.names = {}
+        self.rows = 0
+        self.bad_rows = []
+
+    def add_rows(self, rows, first_row):
+        """Add log rows, the first being sheet row first_row"""
+        given = self.given
+        received = self.received
+        for row_number, row in enumerate(rows, start=first_row):
+            self.rows += 1
+            try:
+                quantity = int(row[LOG_QUANTITY])
+                name = row[LOG_MEDICATION]
+            except (IndexError, ValueError):
+                self.bad_rows.append(row_number)
+                continue
+            key = medication_key(name)
+            self.names.setdefault(key, name)
+            if row[LOG_SURNAME] == RECEIPT_MARKER:
+                received[key] = received.get(key, 0) + quantity
+            else:
+                given[key] = given.get(key, 0) + quantity
+
+
+class Discrepancy:
+    __slots__ = ('medication_name', 'opening', 'received', 'given',
+                 'expected', 'actual')
+
+    def __init__(self, medication_name, opening, received, given, actual):
+        self.medication_name = medication_name
+        self.opening = opening
+        self.received = received
+        self.given = given
+        self.expected = opening + received - given
+        self.actual = actual
+
+    def description(self):
+        if self.actual is None:
+            return (f"{self.medication_name}: {self.given} given and "
+                    f"{self.received} received, not in the inventory")
+        return (f"{self.medication_name}: expected {self.expected} "
+                f"({self.opening} + {self.received} received - "
+                f"{self.given} given), inventory shows {self.actual}, "
+                f"difference {self.actual - self.expected:+d}")
+
+
+def compare(opening, stock, movements):
+    """
+    Discrepancies between the expected and actual stock, and the names
+    of medications with no opening stock to check against. opening maps
+    medication_key to quantity, stock to (name, quantity).
+    """
+    discrepancies = []
+    unchecked = []
+    for key in sorted(set(stock) | set(movements.names)):
+        given = movements.given.get(key, 0)
+        received = movements.received.get(key, 0)
+        actual = stock.get(key)
+        name = movements.names.get(key, key)
+        if actual is None:
+            discrepancies.append(Discrepancy(name, 0, received, given, None))
+        elif key not in opening:
+            unchecked.append(actual[0])
+        else:
+            discrepancy = Discrepancy(
+                actual[0], opening[key], received, given, actual[1]
+            )
+            if discrepancy.expected != discrepancy.actual:
+                discrepancies.append(discrepancy)
+    return discrepancies, unchecked
+
+
+def load_state(path=RECONCILIATION_FILE):
+    """The last reconciliation's position and stock, None if never run"""
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as state:
+        return json.load(state)
+
+
+def save_state(next_row, stock, path=RECONCILIATION_FILE):
+    state = {
+        "next_row": next_row,
+        "stock": {key: quantity for key, (_, quantity) in stock.items()},
+        "reconciled_at": time.strftime("%d-%m-%Y %H:%M:%S"),
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as out:
+        json.dump(state, out)
+    os.replace(tmp_path, path)
@@ -1,9 +1,29 @@
+import argparse
+import csv
 import logging
+import operator
+import os
+import sys
+from array import array
 from datetime import datetime
-import logging
-from nurse import get_nurses_from_sheet, validate_pin
-import gspread
-from google.oauth2.service_account import Credentials
+from itertools import compress, repeat
+from nurse import NurseRoster, get_nurses_from_sheet
+from bulk_import import import_file, read_records, validate_record
+from guideline_corpus import GuidelineCorpus
+import journal_files
+from log_writer import AdministrationLogWriter
+from reconcile import (
+    RECEIPT_MARKER, RECONCILIATION_FILE, Movements, compare, load_state,
+    medication_key, save_state
+)
+from sheets import (
+    PAGE_SIZE, SHEET_TTLS, SPREADSHEET_NAME, WORKSHEET_NAMES, SheetCache,
+    WorksheetRegistry, iter_pages
+)
+from storage import get_backend
+from transactions import StockChange, StockConflict, TransactionJournal
+from search import FuzzyIndex, SubstringIndex
+from snapshot import load_snapshot, save_snapshot
 import re
 from colorama import Fore, Back, Style
 
@@ -14,26 +34,26 @@ logging.basicConfig(
     datefmt='%d-%m-%Y %H:%M:%S'
 )
 
-SCOPE = [
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive.file",
-    "https://www.googleapis.com/auth/drive"
-]
-
-CREDS = Credentials.from_service_account_file('creds.json')
-SCOPED_CREDS = CREDS.with_scopes(SCOPE)
-GSPREAD_CLIENT = gspread.authorize(SCOPED_CREDS)
-SHEET = GSPREAD_CLIENT.open('medication_inventory')
-
-WORKSHEETS = {
-    "nurse_pin": SHEET.worksheet("nurse_pin"),
-    "inventory": SHEET.worksheet("inventory"),
-    "patient_information": SHEET.worksheet("patient_information"),
-    "medication_administration_logs": SHEET.worksheet(
-        "medication_administration_logs"
-    ),
-    "guidelines": SHEET.worksheet("guidelines")
-}
+# MEDAPP_BACKEND picks where the worksheets live, see storage.py
+STORAGE = get_backend()
+WORKSHEETS = WorksheetRegistry(
+    SPREADSHEET_NAME, WORKSHEET_NAMES, cache=SheetCache(SHEET_TTLS),
+    spreadsheet_factory=STORAGE.open
+)
+
+LOG_WRITER = AdministrationLogWriter(
+    lambda: WORKSHEETS["medication_administration_logs"]
+)
+TRANSACTIONS = TransactionJournal(lambda: WORKSHEETS["inventory"], LOG_WRITER)
+
+# Sheets the menus read, downloaded in the background after login.
+# MEDAPP_PREFETCH=0 turns this off.
+PREFETCH_ENV = "MEDAPP_PREFETCH"
+PREFETCH_SHEETS = ("patient_information", "inventory", "guidelines")
+
+# Inventory sheet columns written back by the app (1-based, D and F)
+INVENTORY_QUANTITY_COLUMN = 4
+INVENTORY_LAST_ORDERED_COLUMN = 6
 
 current_nurse_name = ""
 
@@ -82,36 +102,40 @@ def validate_input(prompt, pattern):
         print("Invalid input.")
 
 
-class Nurse:
-    def __init__(self, name, pin):
-        self.name = name
-        self.pin = pin
+# Input patterns shared by the prompts and the bulk import
+ID_PATTERN = r'^\d+$'
+NAME_PATTERN = r'^[a-zA-Z\s]+$'
+DATE_PATTERN = r'^\d{2}-\d{2}-\d{4}$'
+ROOM_PATTERN = r'^[a-zA-Z0-9]+$'
+STRENGTH_PATTERN = r'^[a-zA-Z0-9.\s/]+$'
+QUANTITY_PATTERN = r'^\d+$'
+
+# (column, pattern, convert) in sheet order, see bulk_import.py
+PATIENT_IMPORT_FIELDS = (
+    ("patient_id", ID_PATTERN, None),
+    ("patient_name", NAME_PATTERN, None),
+    ("patient_surname", NAME_PATTERN, None),
+    ("patient_birthdate", DATE_PATTERN, None),
+    ("room_bed_number", ROOM_PATTERN, None),
+)
+MEDICATION_IMPORT_FIELDS = (
+    ("medication_name", NAME_PATTERN, None),
+    ("strength", STRENGTH_PATTERN, None),
+    ("form", NAME_PATTERN, None),
+    ("quantity_in_stock", QUANTITY_PATTERN, int),
+    ("reorder_level", QUANTITY_PATTERN, int),
+    ("last_ordered_date", DATE_PATTERN, None),
+    ("in_stock", r'(?i)^(yes|no|true|false)$',
+     lambda value: 'TRUE' if value.lower() in ('yes', 'true') else 'FALSE'),
+)
+ROUND_FIELDS = (
+    ("patient_id", ID_PATTERN, None),
+    ("medication_name", NAME_PATTERN, None),
+    ("quantity", QUANTITY_PATTERN, int),
+)
 
 
-def get_nurses_from_sheet():
-    """Retrieve nurse data from the nurse_pin worksheet"""
-    records = WORKSHEETS["nurse_pin"].get_all_records()
-    nurses = []
-    for record in records:
-        name = record.get('nurse_name', 'Unknown')
-        pin = str(record.get('nurse_pin', ''))
-        nurses.append(Nurse(name, pin))
-    return nurses
-
-
-def validate_pin(entered_pin, nurses):
-    """
-    Validation check of the pin to gain access into the system.
-    Returns the nurse object if the PIN is valid, None otherwise.
-    """
-    for nurse in nurses:
-        if nurse.pin == entered_pin:
-            logging.info(f"""
-            PIN validation successful for nurse: {nurse.name}
-            """)
-            return nurse
-    logging.info("Pin validation failed")
-    return None
+NURSE_ROSTER = NurseRoster(lambda: get_nurses_from_sheet(backend=STORAGE))
 
 
 def get_login(max_attempts=3):
@@ -119,8 +143,7 @@ def get_login(max_attempts=3):
     Login required to enable system to start, and an added safety measure
     for the BTM safe. Allows up to 3 login attempts.
     """
-    nurses = get_nurses_from_sheet()
-    if not nurses:
+    if not NURSE_ROSTER.load():
         logging.error("Failed to retrieve nurse data from the sheet.")
         print(
             "System error: Unable to access nurse data.",
@@ -136,7 +159,7 @@ def get_login(max_attempts=3):
         print("Watch for spaces between numbers\n")
         entered_pin = get_non_empty_input("Enter your pin here:",
                                           r'^\d{4}$').strip()
-        nurse = validate_pin(entered_pin, nurses)
+        nurse = NURSE_ROSTER.lookup(entered_pin)
         if nurse:
             print(f"\nWelcome, {nurse.name}!")
             return nurse.name
@@ -152,6 +175,11 @@ def get_login(max_attempts=3):
 
 class PatientInformation:
     """Patient Information Class"""
+    __slots__ = (
+        'patient_id', 'patient_name', 'patient_surname',
+        'patient_birthdate', 'room_bed_number'
+    )
+
     def __init__(
         self,
         patient_id,
@@ -178,9 +206,13 @@ class PatientInformation:
 
 def get_patient_info(worksheet):
     """Retrieve Patient information from the worksheet"""
+    return patients_from_rows(worksheet.get_all_values()[1:])
+
+
+def patients_from_rows(rows):
+    """PatientInformation for each patient sheet row, header excluded"""
     patients = []
-    data = worksheet.get_all_values()[1:]
-    for row in data:
+    for row in rows:
         patient = PatientInformation(
             row[0], row[1], row[2], row[3], row[4]
         )
@@ -188,6 +220,30 @@ def get_patient_info(worksheet):
     return patients
 
 
+def refresh_patients(patients, patient_index):
+    """
+    Bring the patient list up to date after a change. While the cached
+    sheet is fresh only rows added since it was loaded are fetched and
+    merged in, otherwise the whole sheet is read again. Returns the
+    patient list and index to use from now on.
+    """
+    worksheet = WORKSHEETS["patient_information"]
+    if worksheet.refresh_tail() is None:
+        patients = get_patient_info(worksheet)
+        return patients, build_patient_index(patients)
+    # Rows past the list, ours and any another session added before it
+    for row in worksheet.cached_rows(len(patients) + 2):
+        patient = PatientInformation(row[0], row[1], row[2], row[3], row[4])
+        patients.append(patient)
+        patient_index.add(patient)
+    return patients, patient_index
+
+
+def build_patient_index(patients):
+    """Surname search index over the patient list"""
+    return SubstringIndex(lambda p: p.patient_surname, patients)
+
+
 def display_patient_menu():
     print("\nPatient Information Menu:")
     print("1. View all Patients")
@@ -196,13 +252,13 @@ def display_patient_menu():
     print("4. Return to main Menu")
 
 
-def search_patient(patients):
+def search_patient(patients, patient_index=None):
+    if patient_index is None:
+        patient_index = build_patient_index(patients)
     patient_surname = get_non_empty_input(
         "Enter patient surname:", r'^[a-zA-Z\s]+$'
     ).strip().lower()
-    found_patients = [
-        p for p in patients if patient_surname in p.patient_surname.lower()
-    ]
+    found_patients = patient_index.search(patient_surname)
     if not found_patients:
         print("No patients found with that surname.")
         return None
@@ -218,8 +274,9 @@ def search_patient(patients):
         while True:
             try:
                 patient_choice = int(get_non_empty_input(
-                    "Enter the number of the patient you want to select:"
-                ).strip(), r'^\d+$') - 1
+                    "Enter the number of the patient you want to select:",
+                    r'^\d+$'
+                ).strip()) - 1
                 if 0 <= patient_choice < len(found_patients):
                     selected_patient = found_patients[patient_choice]
                     print(f"""
@@ -240,20 +297,16 @@ def search_patient(patients):
 
 
 def add_new_patient(worksheet):
-    patient_id = validate_input("Enter patient ID: ", r'^\d+$')
-    patient_name = validate_input(
-        "Enter patient's name: ", r'^[a-zA-Z\s]+$'
-    )
+    patient_id = validate_input("Enter patient ID: ", ID_PATTERN)
+    patient_name = validate_input("Enter patient's name: ", NAME_PATTERN)
     patient_surname = validate_input(
-        "Enter patient's surname: ", r'^[a-zA-Z\s]+$'
+        "Enter patient's surname: ", NAME_PATTERN
     )
     patient_birthdate = validate_input(
-        "Enter patient's birthdate (DD-MM-YYYY):",
-        r'^\d{2}-\d{2}-\d{4}$'
+        "Enter patient's birthdate (DD-MM-YYYY):", DATE_PATTERN
     )
     patient_room_bed_number = validate_input(
-        "Enter the room number (XXX): ",
-        r'^[a-zA-Z0-9]+$'
+        "Enter the room number (XXX): ", ROOM_PATTERN
     )
 
     new_patient = PatientInformation(
@@ -273,6 +326,7 @@ def add_new_patient(worksheet):
         ]
     )
     print(f"New patient added: {new_patient.description()}")
+    return new_patient
 
 
 def patient_information_system():
@@ -281,6 +335,7 @@ def patient_information_system():
     information up to Date.
     """
     patients = get_patient_info(WORKSHEETS["patient_information"])
+    patient_index = build_patient_index(patients)
     while True:
         display_patient_menu()
         choice = get_non_empty_input("Enter your choice (1-4):", r'^[1-4]$')
@@ -288,18 +343,25 @@ def patient_information_system():
             for patient in patients:
                 print(patient.description())
         elif choice == '2':
-            selected_patient = search_patient(patients)
+            selected_patient = search_patient(patients, patient_index)
             if selected_patient:
                 print("Patient selected for further actions.")
         elif choice == '3':
             add_new_patient(WORKSHEETS["patient_information"])
-            patients = get_patient_info(WORKSHEETS["patient_information"])
+            patients, patient_index = refresh_patients(
+                patients, patient_index
+            )
         elif choice == '4':
             return None
 
 
 class MedicationInventory:
     """Creates medication Class"""
+    __slots__ = (
+        'medication_name', 'strength', 'form', 'quantity_in_stock',
+        'reorder_level', 'last_ordered_date', 'in_stock'
+    )
+
     def __init__(
         self, medication_name, strength, form, quantity_in_stock,
         reorder_level, last_ordered_date, in_stock
@@ -341,9 +403,13 @@ class MedicationInventory:
 
 def get_medication_information(worksheet):
     """Medication List of Inventory, what's in stock."""
+    return medications_from_rows(worksheet.get_all_values()[1:])
+
+
+def medications_from_rows(rows):
+    """MedicationInventory for each inventory row, header excluded"""
     medications = []
-    data = worksheet.get_all_values()[1:]
-    for row in data:
+    for row in rows:
         medication = MedicationInventory(
             row[0], row[1], row[2], row[3], row[4],
             row[5], row[6] == 'TRUE'
@@ -352,32 +418,184 @@ def get_medication_information(worksheet):
     return medications
 
 
+def _column_property(column):
+    def get(self):
+        return getattr(self._table, column)[self._index]
+
+    def set(self, value):
+        getattr(self._table, column)[self._index] = value
+    return property(get, set)
+
+
+class InventoryRow(MedicationInventory):
+    """A MedicationInventory that reads and writes one InventoryTable row"""
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    medication_name = _column_property('medication_name')
+    strength = _column_property('strength')
+    form = _column_property('form')
+    quantity_in_stock = _column_property('quantity_in_stock')
+    reorder_level = _column_property('reorder_level')
+    last_ordered_date = _column_property('last_ordered_date')
+    in_stock = _column_property('in_stock')
+
+
+class InventoryTable:
+    """
+    Column-oriented inventory. Text columns are lists, quantities and
+    reorder levels are typed integer arrays and the in stock flags a
+    bytearray, so a large inventory takes a fraction of the memory of
+    one object per row and whole columns can be compared at once.
+    table[i] is a MedicationInventory view of row i.
+    """
+    def __init__(self):
+        self.medication_name = []
+        self.strength = []
+        self.form = []
+        self.quantity_in_stock = array('q')
+        self.reorder_level = array('q')
+        self.last_ordered_date = []
+        self.in_stock = bytearray()
+
+    @classmethod
+    def from_values(cls, rows):
+        """Build from inventory sheet rows, without the header row"""
+        table = cls()
+        for row in rows:
+            table.append(
+                row[0], row[1], row[2], row[3], row[4],
+                row[5], row[6] == 'TRUE'
+            )
+        return table
+
+    def append(
+        self, medication_name, strength, form, quantity_in_stock,
+        reorder_level, last_ordered_date, in_stock
+    ):
+        self.quantity_in_stock.append(int(quantity_in_stock))
+        self.reorder_level.append(int(reorder_level))
+        self.medication_name.append(medication_name)
+        self.strength.append(strength)
+        self.form.append(form)
+        self.last_ordered_date.append(last_ordered_date)
+        self.in_stock.append(bool(in_stock))
+
+    def __len__(self):
+        return len(self.medication_name)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return InventoryRow(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield InventoryRow(self, index)
+
+    def low_stock(self):
+        """
+        (shortfall, row index) for every medication at or below its
+        reorder level, biggest shortfall first. The two integer columns
+        are subtracted pairwise in one pass at C speed, no row objects
+        are built.
+        """
+        shortfalls = list(map(
+            operator.sub, self.reorder_level, self.quantity_in_stock
+        ))
+        low = compress(range(len(shortfalls)), map(
+            operator.le, repeat(0), shortfalls
+        ))
+        return sorted(
+            ((shortfalls[index], index) for index in low),
+            key=lambda item: (-item[0], self.medication_name[item[1]])
+        )
+
+
+def get_inventory_table(worksheet):
+    """The inventory sheet as an InventoryTable"""
+    return InventoryTable.from_values(worksheet.get_all_values()[1:])
+
+
+def display_low_stock_report(table):
+    """Every medication at or below its reorder level, worst first"""
+    low_stock = table.low_stock()
+    if not low_stock:
+        print("All medications are above their reorder level.")
+        return low_stock
+    print(f"\nLow stock report: {len(low_stock)} of {len(table)} "
+          f"medications at or below their reorder level")
+    for shortfall, index in low_stock:
+        med = table[index]
+        print(f"{med.medication_name} {med.strength} - "
+              f"Stock: {med.quantity_in_stock}, "
+              f"Reorder level: {med.reorder_level}, "
+              f"Short by: {shortfall}")
+    return low_stock
+
+
+def refresh_medications(medications, medication_index):
+    """
+    Bring the medication list up to date after a change, fetching only
+    the rows added since the inventory was loaded while the cached sheet
+    is fresh. Returns the medication list and index to use from now on.
+    """
+    worksheet = WORKSHEETS["inventory"]
+    if worksheet.refresh_tail() is None:
+        medications = get_medication_information(worksheet)
+        return medications, build_medication_index(medications)
+    for row in worksheet.cached_rows(len(medications) + 2):
+        medication = MedicationInventory(
+            row[0], row[1], row[2], row[3], row[4],
+            row[5], row[6] == 'TRUE'
+        )
+        medications.append(medication)
+        medication_index.add(medication)
+    return medications, medication_index
+
+
+def build_medication_index(medications):
+    """Fuzzy medication name index, best matches first"""
+    return FuzzyIndex(lambda m: m.medication_name, medications)
+
+
 def medication_inventory_system():
     """Menu for the Medication Inventory, what's in stock."""
     medications = get_medication_information(WORKSHEETS["inventory"])
+    medication_index = build_medication_index(medications)
     while True:
         display_medication_menu()
         choice = get_non_empty_input(
-            "Enter your choice (1-5): \n", r'^[1-5]$'
+            "Enter your choice (1-6): \n", r'^[1-6]$'
         ).strip()
         if choice == '1':
             display_all_medications(medications)
         elif choice == '2':
-            search_medication(medications)
+            search_medication(medications, medication_index)
         elif choice == '3':
             add_new_medication(WORKSHEETS["inventory"])
-            medications = get_medication_information(WORKSHEETS["inventory"])
+            medications, medication_index = refresh_medications(
+                medications, medication_index
+            )
         elif choice == '4':
             update_existing_medication(
-                WORKSHEETS["inventory"], medications
+                WORKSHEETS["inventory"], medications, medication_index
             )
         elif choice == '5':
+            display_low_stock_report(
+                get_inventory_table(WORKSHEETS["inventory"])
+            )
+        elif choice == '6':
             break
         else:
             print("Invalid choice. Please try again.")
 
 
-
 def display_all_medications(medications):
     """To show all present medication in stock"""
     print("\nAll Medications in Inventory:")
@@ -390,26 +608,27 @@ def display_medication_menu():
     print("\nMedication Inventory Menu:")
     print("1. Display all medications")
     print("2. Search for a medication")
-    print("3. Update medication stock")
-    print("4. Exit")
+    print("3. Add a new medication")
+    print("4. Update medication stock")
+    print("5. Low stock report")
+    print("6. Exit")
 
 
-def search_medication(meds):
-    """Searching through medication"""
-    result = search_medication(meds)
+def search_medication(meds, medication_index=None):
+    """Searching through medication, closest names first"""
+    if medication_index is None:
+        medication_index = build_medication_index(meds)
     search_term = get_non_empty_input(
         "Enter medication name to search:", r'^[a-zA-Z\s]+$'
     ).strip().lower()
-    matching_medications = [
-        med for med in meds if search_term in med.medication_name.lower()
-    ]
+    matching_medications = medication_index.search(search_term)
     if matching_medications:
         print("\nMatching Medications:")
         for med in matching_medications:
             print(f"""
             {med.medication_name} - Stock: {med.quantity_in_stock}
             """)
-            return matching_medications
+        return matching_medications
     else:
         print("No matching medications found.")
 
@@ -423,12 +642,12 @@ def add_new_medication(worksheet):
         "Enter strength:", r'^[a-zA-Z\s]+$'
     ).strip()
     form = get_non_empty_input("Enter form:", r'^[a-zA-Z\s]+$').strip()
-    quantity_in_stock = int(get_non_empty_input(
-        "Enter quantity in stock: \n").strip(), r'^\d+$'
-    )
-    reorder_level = int(get_non_empty_input(
-        "Enter reorder level:").strip(), r'^[a-zA-Z\s]+$'
-    )
+    quantity_in_stock = int(validate_input(
+        "Enter quantity in stock: \n", QUANTITY_PATTERN
+    ))
+    reorder_level = int(validate_input(
+        "Enter reorder level:", QUANTITY_PATTERN
+    ))
     last_ordered_date = get_non_empty_input(
         "Enter last ordered date (DD-MM-YYYY): ", r'^\d{2}-\d{2}-\d{4}$'
     ).strip()
@@ -446,13 +665,13 @@ def add_new_medication(worksheet):
     )
     worksheet.append_row(
         [
-            new_med.medication_name,
-            new_med.strength,
-            new_med.form,
-            new_med.quantity_in_stock,
-            new_med.reorder_level,
-            new_med.last_ordered_date,
-            'YES' if new_med.in_stock else 'no'
+            new_medication.medication_name,
+            new_medication.strength,
+            new_medication.form,
+            new_medication.quantity_in_stock,
+            new_medication.reorder_level,
+            new_medication.last_ordered_date,
+            'TRUE' if new_medication.in_stock else 'FALSE'
         ]
     )
     print("New medication added successfully:")
@@ -460,16 +679,15 @@ def add_new_medication(worksheet):
     return new_medication
 
 
-def update_existing_medication(worksheet, medications):
+def update_existing_medication(worksheet, medications, medication_index=None):
     """To update stock when new stock arrives after being ordered"""
+    if medication_index is None:
+        medication_index = build_medication_index(medications)
     search_term = get_non_empty_input(
         "Enter medication name to update:", r'^[a-zA-Z\s]+$'
     ).strip().lower()
-    
-    matching_meds = [
-        med for med in medications
-        if search_term in med.medication_name.lower()
-    ]
+
+    matching_meds = medication_index.search(search_term)
     
     if not matching_meds:
         print("No matching medications found.")
@@ -509,25 +727,53 @@ def update_existing_medication(worksheet, medications):
         except ValueError:
             print("Please enter a valid number.")
     
-    selected_med.quantity_in_stock += new_stock
-    selected_med.last_ordered_date = datetime.now().strftime("%d-%m-%Y")
-    
+    if new_stock:
+        # Received stock is a negative administration, so it goes through
+        # the same compare-and-set and lands on whatever another session
+        # left in the cell
+        change = plan_stock_change(selected_med, -new_stock)
+        if change is None:
+            print("Medication stock was not updated.")
+            return
+        try:
+            TRANSACTIONS.commit([change], [
+                receipt_log_row(selected_med, new_stock, current_nurse_name)
+            ])
+        except StockConflict as e:
+            print(f"Error: {str(e)}")
+            print("Medication stock was not updated.")
+            return
+        except Exception as e:
+            logging.error(f"Stock receipt not yet written: {str(e)}")
+            print("The inventory could not be updated right now. The new "
+                  "stock is saved and will be added automatically.")
+            return
+        selected_med.quantity_in_stock = change.new
+
     """Worksheet Update"""
-    inventory_data = worksheet.get_all_records()
-    for idx, row in enumerate(inventory_data, start=2):
-        if row['Medication name'] == selected_med.medication_name:
-            worksheet.update(f"D{idx}", selected_med.quantity_in_stock)
-            worksheet.update(f"F{idx}", selected_med.last_ordered_date)
-            break
-    
+    idx = worksheet.row_number(selected_med.medication_name)
+    if idx is None:
+        print(f"Error: {selected_med.medication_name} not in inventory.")
+        print("Medication stock was not updated.")
+        return
+    selected_med.last_ordered_date = datetime.now().strftime("%d-%m-%Y")
+    worksheet.update_cell(
+        idx, INVENTORY_LAST_ORDERED_COLUMN, selected_med.last_ordered_date
+    )
+
     print("Medication stock updated successfully:")
     print(f"{selected_med.medication_name}\n"
           f"New stock level: {selected_med.quantity_in_stock}")
 
 
-
 class MatchingPatientsWithMedication:
     """ Patient registration for medication """
+    __slots__ = (
+        'patient_surname', 'patient_name', 'patient_birthdate',
+        'patient_id', 'medication_name', 'medication_quantity',
+        'medication_strength', 'guidelines'
+    )
+
     def __init__(
         self, patient_surname,
         patient_name,
@@ -547,96 +793,44 @@ class MatchingPatientsWithMedication:
         self.medication_strength = medication_strength
         self.guidelines = guidelines
 
-        def full_details(self):
-            return f"""
-        Patient list, Surname:{self.patient_surname}
-        First Name{self.patient_name}
-
-        Birthdate:{self.self.patient_birthdate}
-
-        ID: {self.patient_id}
-
-        Medication: {self.medication_name}
+    def full_details(self):
+        return f"""
+    Patient list, Surname:{self.patient_surname}
+    First Name{self.patient_name}
 
-        Quantity: {self.medication_quantity}
+    Birthdate:{self.patient_birthdate}
 
-        Medication Dosage: {self.medication_strength}
+    ID: {self.patient_id}
 
-        Guidelines: {self.guidelines}
-            """
+    Medication: {self.medication_name}
 
+    Quantity: {self.medication_quantity}
 
-def update_inventory(medication, quantity_administered):
-    """Updating local Inventory on Google Sheets, after intake arrival"""
-    inventory_worksheet = WORKSHEETS["inventory"]
-    inventory_data = inventory_worksheet.get_all_records()
-
-    for idx, row in enumerate(inventory_data, start=2):
-        if row['Medication name'] == medication.medication_name:
-            try:
-                current_quantity = int(row.get('Quantity in stock'[1:]))
-                new_quantity = current_quantity + quantity_administered
-
-                print(f"Debug: Current quantity: {current_quantity}")
-                print(f"""
-                Debug: Quantity administered: {quantity_administered}
-                """)
-                print(f"Debug: New quantity: {new_quantity}")
-                try:
-                    inventory_worksheet.update_cell(idx, 4, str(new_quantity))
-                    print(f"Updated cell D{idx} with value {new_quantity}")
-                except gspread.exceptions.APIError as e:
-                    print(f"API Error while updating inventory: {e}")
-                    return False
-
-                medication.quantity_in_stock = new_quantity
-
-                print(f"""
-                Inventory updated. New quantity for
-                {medication.medication_name}:
-                {new_quantity}
-                """)
-                return True
-                if new_quantity < 0:
-                    print(f"""
-                    Error: Not enough {medication.medication_name} in stock.
-                    Current stock: {current_quantity}
-                    """)
-                    return False
+    Medication Dosage: {self.medication_strength}
 
-                medication.quantity_in_stock = new_quantity
-                inventory_worksheet.update(f"D{idx}", new_quantity)
-
-                print(f"Inventory updated. New quantity for",
-                      f"{medication.medication_name}: {new_quantity}")
-                return True
-            except ValueError:
-                print(f"""
-                Error: Invalid quantity in stock for {
-                    medication.medication_name
-                }.
-                """)
-                return False
-
-    print(f"Error: {medication.medication_name} not found in inventory.")
-    return False
+    Guidelines: {self.guidelines}
+        """
 
 
-def administer_medication(patients, medications, nurse_name):
+def administer_medication(
+    patients, medications, nurse_name, patient_index=None,
+    medication_index=None
+):
     """
     Entering the Patients surname, medication name, authorising nurse
     and amount here required.
     """
     print("Starting administer_medication function")
+    if patient_index is None:
+        patient_index = build_patient_index(patients)
+    if medication_index is None:
+        medication_index = build_medication_index(medications)
     # Patient selection
     while True:
         patient_surname = get_non_empty_input(
             "Enter patient surname:", r'^[a-zA-Z\s]+$'
         ).strip().lower()
-        found_patients = [
-            p for p in patients if patient_surname
-            in p.patient_surname.lower()
-        ]
+        found_patients = patient_index.search(patient_surname)
         if not found_patients:
             print("No patients found with that surname.")
             continue_search = get_non_empty_input(
@@ -667,7 +861,7 @@ def administer_medication(patients, medications, nurse_name):
                     selected_patient = found_patients[patient_choice]
                     print(f"Selected patient: "
                           f"{selected_patient.description()}")
-                    return selected_patient
+                    break
             except ValueError:
                 print("Invalid input. Please enter a valid number.")
     print("Patient selection complete")
@@ -678,10 +872,8 @@ def administer_medication(patients, medications, nurse_name):
             "Enter the name of the medication required:",
             r'^[a-zA-Z\s]+$'
         ).strip()
-        matching_medications = [
-            m for m in medications
-            if medication_name.lower() in m.medication_name.lower()
-        ]
+        matches = medication_index.matches(medication_name)
+        matching_medications = [med for med, _ in matches]
 
         if not matching_medications:
             print("No matching medications found.")
@@ -696,13 +888,21 @@ def administer_medication(patients, medications, nurse_name):
 
     print(f"Found {len(matching_medications)} matching medications")
 
-    if len(matching_medications) == 1:
+    # Only a name that contains what was typed is picked without asking,
+    # a look-alike such as Hydralazine for hydroxyzine must be chosen
+    contained = [med for med, contains in matches if contains]
+    if len(contained) == 1 and len(matches) == 1:
         selected_med = matching_medications[0]
         print(f"Selected medication: {selected_med.description()}")
     else:
-        print("\nMultiple medications found. Please select:")
-        for idx, med in enumerate(matching_medications, start=1):
-            print(f"{idx}. {med.description()}")
+        if contained:
+            print("\nMultiple medications found. Please select:")
+        else:
+            print(f"\nNo medication is called {medication_name}. "
+                  f"Did you mean:")
+        for idx, (med, contains) in enumerate(matches, start=1):
+            similar = "" if contains or not contained else " (similar name)"
+            print(f"{idx}. {med.description()}{similar}")
 
         while True:
             try:
@@ -763,13 +963,9 @@ def administer_medication(patients, medications, nurse_name):
         "Confirm administration? (y/n):", r'^(yes|no)$'
     ).strip().lower()
     if confirm == 'y':
-        if update_inventory(selected_med, quantity):
-            log_administration(
-                selected_patient,
-                selected_med,
-                quantity,
-                nurse_name
-            )
+        if give_doses([(selected_patient, selected_med, quantity)],
+                      nurse_name):
+            print("Administration logged successfully.\n")
             check_low_stock(selected_med)
         else:
             print("Administration cancelled due to inventory issues.")
@@ -779,39 +975,82 @@ def administer_medication(patients, medications, nurse_name):
     print("Administer_medication function completed")
 
 
-def update_inventory(medication, quantity_administered):
+def plan_stock_change(medication, quantity_administered):
     """
-    Update the inventory after medication administration.
+    The inventory change for giving quantity_administered of a
+    medication, from the latest stock the app has seen. None, with the
+    reason printed, if the stock can't cover it.
     """
     inventory_worksheet = WORKSHEETS["inventory"]
-    inventory_data = inventory_worksheet.get_all_records()
-
-    for idx, row in enumerate(inventory_data, start=2):
-        if row['Medication name'] == medication.medication_name:
-            try:
-                current_quantity = int(row.get('Quantity in stock', 0))
-                new_quantity = current_quantity - quantity_administered
-            except ValueError:
-                print(f"Error: Invalid quantity in stock for "
-                      f"{medication.medication_name}.")
-                return False
-
-            if new_quantity < 0:
-                print(f"Error: Not enough {medication.medication_name} "
-                      f"in stock.")
-                print(f"Current stock: {current_quantity}")
-                return False
+    idx = inventory_worksheet.row_number(medication.medication_name)
+    if idx is None:
+        print(f"Error: {medication.medication_name} not in inventory.")
+        return None
 
-            medication.quantity_in_stock = new_quantity
-            inventory_worksheet.update(f"D{idx}", new_quantity)
+    row = inventory_worksheet.cached_row(idx)
+    try:
+        current_quantity = int(row[INVENTORY_QUANTITY_COLUMN - 1])
+        new_quantity = current_quantity - quantity_administered
+    except (IndexError, ValueError):
+        print(f"Error: Invalid quantity in stock for "
+              f"{medication.medication_name}.")
+        return None
 
-            print(f"Inventory updated. New quantity for "
-                  f"{medication.medication_name}: {new_quantity}")
-            return True
+    if new_quantity < 0:
+        print(f"Error: Not enough {medication.medication_name} "
+              f"in stock.")
+        print(f"Current stock: {current_quantity}")
+        return None
+    return StockChange(
+        medication.medication_name, INVENTORY_QUANTITY_COLUMN,
+        current_quantity, new_quantity
+    )
 
-    print(f"Error: {medication.medication_name} not in inventory.")
-    return False
 
+def give_doses(doses, nurse_name):
+    """
+    Take (patient, medication, quantity) doses out of the inventory and
+    log them as one transaction, see transactions.py. Nothing is written
+    if any medication can't cover its total.
+    """
+    if TRANSACTIONS.pending:
+        TRANSACTIONS.recover()
+        if TRANSACTIONS.pending:
+            # New stock levels would be worked out from figures that
+            # don't include the earlier administration yet
+            print("An earlier administration is still waiting to be "
+                  "written to the inventory. Please try again shortly.")
+            return False
+    totals = {}
+    for _, medication, quantity in doses:
+        totals[medication] = totals.get(medication, 0) + quantity
+
+    changes = {}
+    for medication, total in totals.items():
+        change = plan_stock_change(medication, total)
+        if change is None:
+            return False
+        changes[medication] = change
+
+    log_rows = [
+        administration_log_row(patient, medication, quantity, nurse_name)
+        for patient, medication, quantity in doses
+    ]
+    try:
+        TRANSACTIONS.commit(list(changes.values()), log_rows)
+    except StockConflict as e:
+        print(f"Error: {str(e)}")
+        return False
+    except Exception as e:
+        logging.error(f"Administration not yet written: {str(e)}")
+        print("The inventory could not be updated right now. The "
+              "administration is saved and will be completed "
+              "automatically.")
+    for medication, change in changes.items():
+        medication.quantity_in_stock = change.new
+        print(f"Inventory updated. New quantity for "
+              f"{medication.medication_name}: {change.new}")
+    return True
 
 
 def check_low_stock(medication):
@@ -825,17 +1064,14 @@ def check_low_stock(medication):
         Current stock: {medication.quantity_in_stock}.
         Reorder level: {medication.reorder_level}.
         """)
-print(f"""
+        print(f"""
 {Back.GREEN}Please reorder today.{Style.RESET_ALL}
 """)
 
-def log_administration(patient, medication, quantity, nurse_name):
-    """
-    Administration Log in, to keep all outgoing medication on patients,
-    and through which nurse was the opiate given. Here it will be
-    logged under 'Medication Administration Logs'.
-    """
-    log_entry = [
+
+def administration_log_row(patient, medication, quantity, nurse_name):
+    """The medication_administration_logs row for one dose"""
+    return [
         datetime.now().strftime("%d-%m-%Y %H:%M:%S"),
         patient.patient_surname,
         patient.patient_name,
@@ -845,11 +1081,110 @@ def log_administration(patient, medication, quantity, nurse_name):
         nurse_name
     ]
 
-    WORKSHEETS["medication_administration_logs"].append_row(log_entry)
-    print("Administration logged successfully.\n")
+
+def receipt_log_row(medication, quantity, nurse_name):
+    """
+    The log row recording stock received, so the log accounts for every
+    stock movement, see reconcile.py
+    """
+    return [
+        datetime.now().strftime("%d-%m-%Y %H:%M:%S"),
+        RECEIPT_MARKER,
+        "",
+        medication.medication_name,
+        str(quantity),
+        medication.strength,
+        nurse_name
+    ]
+
+
+def plan_medication_round(path, patients, medications):
+    """
+    Read a medication round from a CSV or JSONL file of patient_id,
+    medication_name and quantity, see plan_doses.
+    """
+    return plan_doses(read_records(path), patients, medications)
+
+
+def plan_doses(records, patients, medications, label="Line"):
+    """
+    Match each (number, record) of patient_id, medication_name and
+    quantity to a patient and a medication by exact id and name. The
+    stock is checked against the total of each medication across all
+    the records.
+    Returns the doses as (patient, medication, quantity) and a list of
+    problems; the doses should only be given if there are none.
+    """
+    patients_by_id = {}
+    for patient in patients:
+        patients_by_id.setdefault(patient.patient_id, patient)
+    medications_by_name = {}
+    for medication in medications:
+        medications_by_name.setdefault(
+            medication.medication_name.strip().lower(), medication
+        )
+
+    doses = []
+    problems = []
+    for number, record in records:
+        row, errors = validate_record(record, ROUND_FIELDS)
+        if not errors:
+            patient_id, medication_name, quantity = row
+            patient = patients_by_id.get(patient_id)
+            medication = medications_by_name.get(medication_name.lower())
+            if patient is None:
+                errors.append(f"no patient with ID {patient_id}")
+            if medication is None:
+                errors.append(f"{medication_name} is not in the inventory")
+            if quantity <= 0:
+                errors.append("quantity must be more than 0")
+        if errors:
+            problems.append(f"{label} {number}: {'; '.join(errors)}")
+        else:
+            doses.append((patient, medication, quantity))
+
+    totals = {}
+    for _, medication, quantity in doses:
+        totals[medication] = totals.get(medication, 0) + quantity
+    for medication, total in totals.items():
+        if total > medication.quantity_in_stock:
+            problems.append(
+                f"Not enough {medication.medication_name} for the round: "
+                f"{total} needed, {medication.quantity_in_stock} in stock"
+            )
+    return doses, problems
+
+
+def give_medication_round(doses, nurse_name):
+    """
+    Give the whole round as one transaction: every stock change in one
+    batched write, then every log row in one append.
+    """
+    if not give_doses(doses, nurse_name):
+        print("Round cancelled, the inventory was not changed.")
+        return False
+    print(f"{len(doses)} administrations logged.")
+    for medication in {medication for _, medication, _ in doses}:
+        check_low_stock(medication)
+    return True
 
 
 def main():
+    STORAGE.start()
+    snapshot_source = f"{STORAGE.name}:{STORAGE.spreadsheet_name}"
+    loaded = load_snapshot(WORKSHEETS.cache, PREFETCH_SHEETS, snapshot_source)
+    try:
+        start_session(refresh=bool(loaded))
+    finally:
+        save_snapshot(WORKSHEETS.cache, PREFETCH_SHEETS, snapshot_source)
+        STORAGE.stop()
+
+
+def start_session(refresh=False):
+    """
+    Log the nurse in and run the menus until they exit. With refresh
+    the prefetch downloads sheets already cached, to replace a snapshot.
+    """
     global current_nurse_name
 
     current_nurse_name = get_login()
@@ -864,6 +1199,19 @@ def main():
     """)
     print("Access granted. Proceeding with the application... \n")
 
+    if os.environ.get(PREFETCH_ENV, "1") != "0":
+        WORKSHEETS.prefetch(PREFETCH_SHEETS, refresh=refresh)
+    LOG_WRITER.start()
+    TRANSACTIONS.recover()
+    try:
+        main_menu()
+    finally:
+        LOG_WRITER.close()
+        TRANSACTIONS.close()
+
+
+def main_menu():
+    """Main menu loop, shown once the nurse has logged in"""
     while True:
         print("\nMain Menu:")
         print("1. Patient Information System")
@@ -899,7 +1247,20 @@ def main():
 
 def guidelines_system():
     """Menu for Opitate Medicine guidelines"""
-    guidelines = get_guidelines(WORKSHEETS["guidelines"])
+    guidelines_menu(get_guideline_corpus())
+
+
+def get_guideline_corpus():
+    """
+    The full-text corpus of the guidelines sheet, see guideline_corpus.py.
+    Opened, and rebuilt if the sheet changed, once per download.
+    """
+    return WORKSHEETS["guidelines"].derived(
+        "corpus", lambda values: GuidelineCorpus.for_rows(values[1:])
+    )
+
+
+def guidelines_menu(corpus):
     while True:
         print("\nGuidelines Menu:")
         print("1. View all Guidelines")
@@ -909,38 +1270,49 @@ def guidelines_system():
             "Enter your choice (1-3):", r'^\d+$'
         )
         if choice == '1':
-            display_all_guidelines(guidelines)
+            display_all_guidelines(guidelines_from_rows(
+                WORKSHEETS["guidelines"].get_all_values()[1:]
+            ))
         elif choice == '2':
-            search_guidelines(guidelines)
+            search_guidelines(corpus)
         elif choice == '3':
             break
         else:
             print("Invalid choice. Please try again.")
 
 
-def get_guidelines(worksheet):
-    """Glossary index for Guidelines when working with BTM"""
+class Guideline:
+    """
+    One row of the guidelines sheet. Fields can also be read as
+    guideline['field_name'], like the dicts this replaced.
+    """
+    __slots__ = (
+        'medication_name', 'administration_guidelines', 'dosage_guidelines',
+        'intervals', 'potential_side_effects', 'emergency_procedures',
+        'additional_notes'
+    )
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    def __getitem__(self, field):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        return getattr(self, field)
+
+
+def guidelines_from_rows(rows):
+    """Guideline for each guidelines sheet row, header excluded"""
     guidelines = []
-    data = worksheet.get_all_values()[1:]
-    for row in data:
-        guideline = {
-            'medication_name': row[0],
-            'administration_guidelines': row[1],
-            'dosage_guidelines': row[2],
-            'intervals': row[3],
-            'potential_side_effects': row[4],
-            'emergency_procedures': row[5],
-            'additional_notes': row[6]
-        }
-        guidelines.append(guideline)
+    for row in rows:
+        guidelines.append(Guideline(*(list(row) + [''] * 7)[:7]))
     return guidelines
 
 
 def display_all_guidelines(guidelines):
     for guideline in guidelines:
-        print(f"\nMedication: {guideline['medication']}")
-        print(f"Frequency: {guideline['frequency']}")
-        print(f"Special instructions: {guideline['special_instructions']}")
+        display_guideline(guideline)
 
 
 def display_guideline(guideline):
@@ -957,23 +1329,275 @@ def display_guideline(guideline):
     print(f"Additional Notes: {guideline['additional_notes']}")
 
 
-def search_guidelines(guidelines):
+def search_guidelines(corpus):
+    """
+    Guidelines whose medication name contains the search term, then
+    those with the term as a phrase in any field, e.g. "respiratory
+    depression". Both are read from the corpus, and only the guidelines
+    found are loaded.
+    """
     search_term = get_non_empty_input(
         "Enter medication name or guideline to search:", r'^[a-zA-Z\s]+$'
         ).lower()
-    found_guidelines = [
-        g for g in guidelines if search_term
-        in g['medication_name'].lower()
+    found = [
+        index for index in range(len(corpus))
+        if search_term in corpus.field(index, 0).lower()
     ]
-    if found_guidelines:
-        for guideline in found_guidelines:
-            display_guideline(guideline)
+    seen = set(found)
+    matched_fields = {}
+    for index, fields in corpus.search(search_term):
+        if index not in seen:
+            seen.add(index)
+            found.append(index)
+        matched_fields[index] = fields
+    if found:
+        for index in found:
+            display_guideline(Guideline(*corpus.row(index)))
+            if matched_fields.get(index):
+                names = ", ".join(
+                    Guideline.__slots__[field].replace('_', ' ')
+                    for field in matched_fields[index]
+                )
+                print(f"Matched in: {names}")
     else:
         print("No matching guidelines found.")
 
 
+def parse_args(argv=None):
+    """
+    Command line options. With no command the interactive app starts,
+    which is what the terminal wrapper runs.
+    """
+    parser = argparse.ArgumentParser(
+        description="Medication Administration App"
+    )
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser(
+        "low-stock",
+        help="print every medication at or below its reorder level"
+    )
+    for name, what in (("patients", "patient"), ("medications", "medication")):
+        importer = commands.add_parser(
+            f"import-{name}",
+            help=f"add {what} rows from a CSV (with header) or JSONL file"
+        )
+        importer.add_argument("path")
+        importer.add_argument(
+            "--dry-run", action="store_true",
+            help="validate the file without writing to the sheet"
+        )
+    export = commands.add_parser(
+        "export-logs",
+        help="write the administration log as CSV, read page by page"
+    )
+    export.add_argument(
+        "--output", help="file to write, standard output if not given"
+    )
+    export.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    reconcile = commands.add_parser(
+        "reconcile",
+        help="check stock movements against the administration log"
+    )
+    reconcile.add_argument("--state", default=RECONCILIATION_FILE)
+    reconcile.add_argument(
+        "--reset", action="store_true",
+        help="record today's stock as the starting point and stop"
+    )
+    round_parser = commands.add_parser(
+        "administer-round",
+        help="give a medication round listed in a CSV or JSONL file"
+    )
+    round_parser.add_argument("path")
+    round_parser.add_argument(
+        "--dry-run", action="store_true",
+        help="check the round without giving it"
+    )
+    return parser.parse_args(argv)
+
+
+def run_command(args):
+    """Run a non-interactive command, returns the process exit code"""
+    if args.command == "low-stock":
+        display_low_stock_report(get_inventory_table(WORKSHEETS["inventory"]))
+        return 0
+    if args.command in ("import-patients", "import-medications"):
+        return import_command(args)
+    if args.command == "administer-round":
+        return medication_round_command(args)
+    if args.command == "export-logs":
+        return export_logs_command(args)
+    if args.command == "reconcile":
+        return reconcile_command(args)
+    return 2
+
+
+def reconcile_command(args):
+    """
+    Reconcile the log rows added since the last run against the stock
+    then and now, see reconcile.py. The first run, or one with --reset,
+    only records the starting point.
+    """
+    # Doses still on their way to the sheets would show as discrepancies
+    # and shift the starting point saved for next time
+    TRANSACTIONS.recover()
+    LOG_WRITER.close()
+    TRANSACTIONS.close()
+    unsent = TRANSACTIONS.pending + LOG_WRITER.pending
+    if unsent:
+        print(f"{unsent} administrations or log rows could not be sent to "
+              f"the sheets yet. Please try again when they have been.")
+        return 1
+    # Only this process's journals were drained. Another nurse's session
+    # may have stock written whose log rows haven't reached the sheet
+    busy = journal_files.busy(TRANSACTIONS.base_path, TRANSACTIONS.path) \
+        + journal_files.busy(LOG_WRITER.journal_base, LOG_WRITER.journal_path)
+    if busy:
+        print("Other sessions are still writing administrations to the "
+              "sheets. Please try again when they have finished.")
+        for path in busy:
+            logging.info(f"Reconcile waiting on {path}")
+        return 1
+    inventory = WORKSHEETS["inventory"]
+    inventory.invalidate()
+    stock = {}
+    for medication in get_medication_information(inventory):
+        stock.setdefault(
+            medication_key(medication.medication_name),
+            (medication.medication_name, medication.quantity_in_stock)
+        )
+
+    state = None if args.reset else load_state(args.state)
+    first_row = state["next_row"] if state else 2
+    movements = Movements()
+    next_row = first_row
+    for page in iter_pages(
+        WORKSHEETS["medication_administration_logs"], first_row=first_row
+    ):
+        if state:
+            movements.add_rows(page, next_row)
+        next_row += len(page)
+    save_state(next_row, stock, args.state)
+
+    if not state:
+        print(f"Starting point recorded: stock of {len(stock)} medications "
+              f"at log row {next_row}.")
+        return 0
+    discrepancies, unchecked = compare(state["stock"], stock, movements)
+    print(f"Reconciled {movements.rows} log rows since "
+          f"{state['reconciled_at']}.")
+    for row_number in movements.bad_rows:
+        print(f"Log row {row_number} has no valid medication quantity.")
+    for name in unchecked:
+        print(f"{name} was added since the last reconciliation, "
+              f"it will be checked from now on.")
+    for discrepancy in discrepancies:
+        print(f"{Fore.RED}DISCREPANCY{Style.RESET_ALL} "
+              f"{discrepancy.description()}")
+        logging.warning(f"Reconciliation: {discrepancy.description()}")
+    if not discrepancies:
+        print("Stock matches the administration log.")
+    return 1 if discrepancies or movements.bad_rows else 0
+
+
+def export_logs_command(args):
+    """
+    Stream the administration log to CSV. Rows are written as each page
+    arrives, so memory use doesn't grow with the length of the log.
+    """
+    worksheet = WORKSHEETS["medication_administration_logs"]
+    header = worksheet.get("A1:ZZ1")
+    if not header:
+        print("The administration log is empty.")
+        return 1
+    output = open(args.output, "w", newline="", encoding="utf-8") \
+        if args.output else sys.stdout
+    try:
+        writer = csv.writer(output)
+        writer.writerow(header[0])
+        count = 0
+        for page in iter_pages(
+            worksheet, args.page_size, width=len(header[0])
+        ):
+            writer.writerows(page)
+            count += len(page)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    logging.info(f"Exported {count} administration log rows")
+    return 0
+
+
+def medication_round_command(args):
+    """Check a medication round file and give it once a nurse logs in"""
+    patients = get_patient_info(WORKSHEETS["patient_information"])
+    medications = get_medication_information(WORKSHEETS["inventory"])
+    try:
+        doses, problems = plan_medication_round(
+            args.path, patients, medications
+        )
+    except OSError as e:
+        print(f"Could not read {args.path}: {e}")
+        return 1
+    for problem in problems:
+        print(problem)
+    if problems:
+        print("Round not given, please correct the file.")
+        return 1
+    for patient, medication, quantity in doses:
+        print(f"{patient.patient_name} {patient.patient_surname}: "
+              f"{quantity} x {medication.medication_name} "
+              f"{medication.strength}")
+    print(f"{len(doses)} administrations in the round.")
+    if args.dry_run:
+        return 0
+
+    nurse_name = get_login()
+    if not nurse_name:
+        return 1
+    try:
+        given = give_medication_round(doses, nurse_name)
+    finally:
+        LOG_WRITER.close()
+        TRANSACTIONS.close()
+    if given:
+        logging.info(
+            f"Medication round of {len(doses)} from {args.path} "
+            f"given by {nurse_name}"
+        )
+    return 0 if given else 1
+
+
+def import_command(args):
+    """Bulk import patients or medications, see bulk_import.py"""
+    if args.command == "import-patients":
+        worksheet = WORKSHEETS["patient_information"]
+        fields = PATIENT_IMPORT_FIELDS
+    else:
+        worksheet = WORKSHEETS["inventory"]
+        fields = MEDICATION_IMPORT_FIELDS
+    try:
+        result = import_file(args.path, worksheet, fields,
+                             dry_run=args.dry_run)
+    except OSError as e:
+        print(f"Could not read {args.path}: {e}")
+        return 1
+    for line_number, problems in result.bad_rows:
+        print(f"Line {line_number}: {'; '.join(problems)}")
+    print(result.summary())
+    logging.info(f"Bulk import of {args.path}: {result.summary()}")
+    return 1 if result.bad_rows else 0
+
+
 if __name__ == "__main__":
+    args = parse_args()
     try:
+        if args.command:
+            STORAGE.start()
+            try:
+                exit_code = run_command(args)
+            finally:
+                STORAGE.stop()
+            raise SystemExit(exit_code)
         welcome()
         main()
     except KeyboardInterrupt:
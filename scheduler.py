@@ -0,0 +1,160 @@
+"""
+Request scheduling for the Google Sheets API.
+
+Every request the gspread client makes goes through RateLimitedSession:
+it waits for a token from a bucket refilled at the Sheets per-user quota,
+so a burst of calls is spread out instead of being refused, and a 429 or
+5xx answer is retried with exponential backoff and full jitter. Counts of
+requests, waits and retries are kept in REQUEST_METRICS.
+"""
+import logging
+import random
+import threading
+import time
+
+from google.auth.transport.requests import AuthorizedSession
+from requests.exceptions import ConnectionError, Timeout
+
+# Sheets allows 60 requests per minute per user, let a few go at once
+REQUESTS_PER_MINUTE = 60
+REQUEST_BURST = 5
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 64.0
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average and up to capacity at
+    once. acquire() blocks until a token is free and returns the seconds
+    it waited.
+    """
+    def __init__(self, rate, capacity, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            self.sleep(delay)
+            waited += delay
+
+
+class RequestMetrics:
+    """Thread safe counters for the Sheets requests made"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.throttle_seconds = 0.0
+        self.retries = 0
+        self.failures = 0
+        self.statuses = {}
+
+    def record(self, status=None, waited=0.0, retried=False, failed=False):
+        with self._lock:
+            self.requests += 1
+            if waited:
+                self.throttled += 1
+                self.throttle_seconds += waited
+            if retried:
+                self.retries += 1
+            if failed:
+                self.failures += 1
+            if status is not None:
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            return (
+                f"{self.requests} Sheets requests, {self.retries} retried, "
+                f"{self.failures} failed, {self.throttled} throttled for "
+                f"{self.throttle_seconds:.1f}s, statuses {self.statuses}"
+            )
+
+
+REQUEST_METRICS = RequestMetrics()
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Full jitter: anywhere up to base * 2**attempt, at most cap"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_idempotent(method, url):
+    """
+    Whether sending the request twice does no harm. Appends are not: a
+    5xx may come back after the rows were added.
+    """
+    return method.upper() != "POST" or ":append" not in url
+
+
+class RateLimitedSession(AuthorizedSession):
+    """
+    An AuthorizedSession that paces requests through a TokenBucket and
+    retries throttled or failed ones. A 429 is always retried since
+    Google did nothing with the request; a 5xx or dropped connection
+    only for requests that are safe to repeat.
+    """
+    def __init__(self, credentials, bucket=None, metrics=REQUEST_METRICS,
+                 max_retries=MAX_RETRIES, sleep=time.sleep, **kwargs):
+        super().__init__(credentials, **kwargs)
+        if bucket is None:
+            bucket = TokenBucket(REQUESTS_PER_MINUTE / 60, REQUEST_BURST)
+        self.bucket = bucket
+        self.metrics = metrics
+        self.max_retries = max_retries
+        self.sleep = sleep
+
+    def request(self, method, url, *args, **kwargs):
+        retry_5xx = is_idempotent(method, url)
+        attempt = 0
+        while True:
+            waited = self.bucket.acquire()
+            response = None
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (ConnectionError, Timeout):
+                if not retry_5xx or attempt >= self.max_retries:
+                    self.metrics.record(waited=waited, failed=True)
+                    raise
+                self.metrics.record(waited=waited, retried=True)
+            else:
+                status = response.status_code
+                retry = status in RETRY_STATUSES \
+                    and (status == 429 or retry_5xx)
+                if not retry or attempt >= self.max_retries:
+                    self.metrics.record(
+                        status, waited, failed=status >= 400
+                    )
+                    return response
+                self.metrics.record(status, waited, retried=True)
+            delay = backoff_delay(attempt)
+            if response is not None:
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            logging.warning(
+                f"Sheets request {method} {url} retried in {delay:.1f}s"
+            )
+            self.sleep(delay)
+            attempt += 1
@@ -0,0 +1,167 @@
+"""
+In-memory search indexes over the app's records.
+"""
+import re
+
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize(text):
+    """Lower-case text with runs of whitespace collapsed to one space"""
+    return _SPACES_RE.sub(" ", str(text)).strip().lower()
+
+
+class SubstringIndex:
+    """
+    Finds the records whose key contains a query, the same answer as
+    `query in key.lower()` over every record, without scanning them all.
+
+    Each normalized key is split into every substring of up to gram_size
+    characters, and each of those maps to the ids of the records that
+    contain it. A short query is a single lookup. A longer one takes the
+    smallest posting set of its grams, narrows it with the others and
+    only checks the few candidates left. Records can be added at any
+    time and results come back in the order the records were added.
+    """
+    def __init__(self, key, records=(), gram_size=3):
+        self.key = key
+        self.gram_size = gram_size
+        self.records = []
+        self._keys = []
+        self._postings = {}
+        self.extend(records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def _grams(self, text):
+        grams = set()
+        for size in range(1, self.gram_size + 1):
+            for start in range(len(text) - size + 1):
+                grams.add(text[start:start + size])
+        return grams
+
+    def add(self, record):
+        record_id = len(self.records)
+        text = normalize(self.key(record))
+        self.records.append(record)
+        self._keys.append(text)
+        for gram in self._grams(text):
+            self._postings.setdefault(gram, set()).add(record_id)
+
+    def extend(self, records):
+        for record in records:
+            self.add(record)
+
+    def search(self, query):
+        query = normalize(query)
+        if not query:
+            return list(self.records)
+        if len(query) <= self.gram_size:
+            ids = self._postings.get(query, ())
+            return [self.records[i] for i in sorted(ids)]
+
+        size = self.gram_size
+        grams = {
+            query[start:start + size]
+            for start in range(len(query) - size + 1)
+        }
+        postings = sorted(
+            (self._postings.get(gram, set()) for gram in grams), key=len
+        )
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates &= posting
+        return [
+            self.records[i] for i in sorted(candidates)
+            if query in self._keys[i]
+        ]
+
+
+class FuzzyIndex:
+    """
+    Ranked, typo tolerant lookup of records by name.
+
+    Names are indexed by their trigrams, padded so the start and end of
+    a word count too. A query scores each record that shares a trigram
+    with it by the Dice coefficient of the two trigram sets, so "morfine"
+    still finds "Morphine". Names that contain the query outright, found
+    through a SubstringIndex, are ranked above every fuzzy match. Only the
+    posting lists of the query's own grams are visited, not every name.
+    """
+    def __init__(self, key, records=(), min_score=0.3):
+        self.key = key
+        self.min_score = min_score
+        self.records = []
+        self._sizes = []
+        self._postings = {}
+        self._substrings = SubstringIndex(lambda entry: entry[1])
+        self.extend(records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    @staticmethod
+    def _trigrams(text):
+        padded = f"  {text} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add(self, record):
+        record_id = len(self.records)
+        text = normalize(self.key(record))
+        trigrams = self._trigrams(text)
+        self.records.append(record)
+        self._substrings.add((record_id, text))
+        self._sizes.append(len(trigrams))
+        for trigram in trigrams:
+            self._postings.setdefault(trigram, []).append(record_id)
+
+    def extend(self, records):
+        for record in records:
+            self.add(record)
+
+    def search(self, query, limit=None):
+        """Records best match first, as many as limit if given"""
+        return [record for record, _ in self.matches(query, limit)]
+
+    def matches(self, query, limit=None):
+        """
+        (record, contains) pairs best match first, where contains is
+        True for a name that contains the query and False for one that
+        is only similar to it.
+        """
+        query = normalize(query)
+        if not query:
+            return [(record, True) for record in self.records]
+        trigrams = self._trigrams(query)
+        shared = {}
+        for trigram in trigrams:
+            for record_id in self._postings.get(trigram, ()):
+                shared[record_id] = shared.get(record_id, 0) + 1
+
+        exact = {
+            record_id for record_id, _ in self._substrings.search(query)
+        }
+        scored = []
+        for record_id in exact.union(shared):
+            count = shared.get(record_id, 0)
+            score = 2 * count / (len(trigrams) + self._sizes[record_id])
+            if record_id in exact:
+                score += 1
+            if score >= self.min_score:
+                scored.append((-score, record_id))
+        scored.sort()
+        if limit is not None:
+            scored = scored[:limit]
+        return [
+            (self.records[record_id], record_id in exact)
+            for _, record_id in scored
+        ]
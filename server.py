@@ -0,0 +1,400 @@
+"""
+HTTP API for the medication workflow.
+
+One long-running process serves every nurse. The worksheets, sheet
+cache, Sheets session, nurse roster and log writer are the ones run.py
+sets up, shared by all requests, so a second nurse costs a connection
+rather than a process that logs in to Google and downloads every sheet
+again. Connections are handled on one asyncio loop and sheet calls go
+through AsyncSheets.
+
+Every request carries the nurse's PIN in an X-Nurse-Pin header. After
+MAX_PIN_FAILURES wrong PINs in a row a client address is locked out,
+for twice as long after each further wrong PIN.
+
+    GET  /patients?surname=       patients whose surname contains it
+    GET  /medications?name=       inventory, best match first
+    GET  /inventory/low-stock     medications at or below reorder level
+    GET  /guidelines?medication=  guidelines, all or for one medication
+    GET  /guidelines?q=           guidelines containing a phrase
+    GET  /logs.csv                the administration log, streamed
+    POST /administrations         {"doses": [{"patient_id": ...,
+                                  "medication_name": ..., "quantity": ...}]}
+
+Run with: python3 server.py --port 8000
+"""
+import argparse
+import asyncio
+import csv
+import io
+import json
+import logging
+import math
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import run
+from async_sheets import AsyncSheets
+from sheets import PAGE_SIZE
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+MAX_BODY = 1024 * 1024
+REQUEST_TIMEOUT = 30
+
+# Wrong PINs a client may send in a row, as get_login allows, and the
+# lockout that follows, doubled for each further wrong PIN
+MAX_PIN_FAILURES = 3
+PIN_LOCKOUT = 30
+MAX_PIN_LOCKOUT = 3600
+MAX_TRACKED_CLIENTS = 10000
+
+REASONS = {
+    200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+    405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large",
+    429: "Too Many Requests", 500: "Internal Server Error"
+}
+
+
+class HTTPError(Exception):
+    """Ends a request with the given status and message"""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def as_dict(record, fields):
+    return {field: getattr(record, field) for field in fields}
+
+
+class PinThrottle:
+    """
+    Wrong PINs per client address. Once a client reaches max_failures
+    in a row it is locked out for lockout seconds, doubling with each
+    further failure up to max_lockout. A right PIN clears its record.
+    Only used from the event loop, so there is no lock.
+    """
+    def __init__(self, max_failures=MAX_PIN_FAILURES, lockout=PIN_LOCKOUT,
+                 max_lockout=MAX_PIN_LOCKOUT, clock=time.monotonic):
+        self.max_failures = max_failures
+        self.lockout = lockout
+        self.max_lockout = max_lockout
+        self._clock = clock
+        self._failures = {}
+
+    def wait_time(self, client):
+        """Seconds until client may try a PIN again, 0 if it may now"""
+        _, locked_until = self._failures.get(client, (0, 0))
+        return max(0, locked_until - self._clock())
+
+    def failed(self, client):
+        """Record a wrong PIN, returns the number in a row"""
+        count = self._failures.get(client, (0, 0))[0] + 1
+        locked_until = 0
+        if count >= self.max_failures:
+            delay = self.lockout * 2 ** (count - self.max_failures)
+            locked_until = self._clock() + min(delay, self.max_lockout)
+        self._failures[client] = (count, locked_until)
+        if len(self._failures) > MAX_TRACKED_CLIENTS:
+            now = self._clock()
+            self._failures = {
+                key: value for key, value in self._failures.items()
+                if value[1] > now
+            }
+        return count
+
+    def succeeded(self, client):
+        self._failures.pop(client, None)
+
+
+class Request:
+    """A parsed HTTP request"""
+    def __init__(self, method, path, query, headers, body, client=None):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+        self.client = client
+
+    def param(self, name, default=""):
+        return self.query.get(name, [default])[0]
+
+    def json(self):
+        try:
+            return json.loads(self.body or b"null")
+        except ValueError:
+            raise HTTPError(400, "Request body is not valid JSON")
+
+
+async def read_request(reader):
+    """Read one request, None if the client closed the connection"""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    try:
+        method, target, _ = request_line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HTTPError(400, "Bad Content-Length")
+    if length > MAX_BODY:
+        raise HTTPError(413, "Request body too large")
+    body = await reader.readexactly(length) if length else b""
+    url = urlsplit(target)
+    return Request(method.upper(), url.path, parse_qs(url.query), headers,
+                   body)
+
+
+def response_head(status, content_type, length=None):
+    lines = [
+        f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+        f"Content-Type: {content_type}",
+        "Connection: close",
+    ]
+    if length is not None:
+        lines.append(f"Content-Length: {length}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def send_json(writer, status, payload):
+    body = json.dumps(payload).encode("utf-8")
+    writer.write(response_head(status, "application/json", len(body)))
+    writer.write(body)
+    await writer.drain()
+
+
+class MedicationAPI:
+    """The endpoints, over one AsyncSheets shared by every connection"""
+    def __init__(self, sheets, throttle=None):
+        self.sheets = sheets
+        self.throttle = throttle or PinThrottle()
+        self.routes = {
+            ("GET", "/patients"): self.patients,
+            ("GET", "/medications"): self.medications,
+            ("GET", "/inventory/low-stock"): self.low_stock,
+            ("GET", "/guidelines"): self.guidelines,
+            ("GET", "/logs.csv"): self.logs_csv,
+            ("POST", "/administrations"): self.administrations,
+        }
+
+    async def rows(self, name):
+        worksheet = await self.sheets.worksheet(name)
+        return (await worksheet.get_all_values())[1:]
+
+    async def nurse(self, request):
+        client = request.client
+        wait = self.throttle.wait_time(client)
+        if wait:
+            raise HTTPError(
+                429, f"Too many wrong PINs, try again in "
+                     f"{math.ceil(wait)} seconds"
+            )
+        pin = request.headers.get("x-nurse-pin", "")
+        nurse = await asyncio.to_thread(run.NURSE_ROSTER.lookup, pin) \
+            if pin else None
+        if not nurse:
+            if pin:
+                failures = self.throttle.failed(client)
+                logging.error(
+                    f"Invalid PIN through the API from {client}, "
+                    f"{failures} in a row"
+                )
+                if failures >= self.throttle.max_failures:
+                    logging.error(
+                        f"Maximum PIN attempts reached, {client} locked "
+                        f"out for {math.ceil(self.throttle.wait_time(client))}"
+                        f" seconds"
+                    )
+            raise HTTPError(401, "A valid X-Nurse-Pin header is required")
+        self.throttle.succeeded(client)
+        return nurse.name
+
+    async def handle(self, request, writer):
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self.routes):
+                raise HTTPError(405, "Method not allowed")
+            raise HTTPError(404, "Not found")
+        nurse_name = await self.nurse(request)
+        result = await handler(request, nurse_name, writer)
+        if result is not None:
+            await send_json(writer, *result)
+
+    async def patients(self, request, nurse_name, writer):
+        patients = run.patients_from_rows(
+            await self.rows("patient_information")
+        )
+        found = run.build_patient_index(patients).search(
+            request.param("surname")
+        )
+        fields = run.PatientInformation.__slots__
+        return 200, [as_dict(patient, fields) for patient in found]
+
+    async def medications(self, request, nurse_name, writer):
+        medications = run.medications_from_rows(await self.rows("inventory"))
+        found = run.build_medication_index(medications).search(
+            request.param("name")
+        )
+        fields = run.MedicationInventory.__slots__
+        return 200, [as_dict(medication, fields) for medication in found]
+
+    async def low_stock(self, request, nurse_name, writer):
+        table = run.InventoryTable.from_values(await self.rows("inventory"))
+        fields = run.MedicationInventory.__slots__
+        report = []
+        for shortfall, index in table.low_stock():
+            medication = as_dict(table[index], fields)
+            medication["in_stock"] = bool(medication["in_stock"])
+            medication["shortfall"] = shortfall
+            report.append(medication)
+        return 200, report
+
+    async def guidelines(self, request, nurse_name, writer):
+        name = request.param("medication").strip().lower()
+        query = request.param("q")
+        if query:
+            corpus = await asyncio.to_thread(run.get_guideline_corpus)
+            guidelines = [
+                run.Guideline(*corpus.row(index))
+                for index, _ in corpus.search(query)
+            ]
+        else:
+            guidelines = run.guidelines_from_rows(
+                await self.rows("guidelines")
+            )
+        if name:
+            guidelines = [
+                guideline for guideline in guidelines
+                if guideline.medication_name.strip().lower() == name
+            ]
+        fields = run.Guideline.__slots__
+        return 200, [as_dict(guideline, fields) for guideline in guidelines]
+
+    async def logs_csv(self, request, nurse_name, writer):
+        """The whole log as CSV, sent as each page is read"""
+        worksheet = await self.sheets.worksheet(
+            "medication_administration_logs"
+        )
+        header = await worksheet.get("A1:ZZ1")
+        writer.write(response_head(200, "text/csv; charset=utf-8"))
+        buffer = io.StringIO()
+        out = csv.writer(buffer)
+        if header:
+            out.writerow(header[0])
+            async for page in worksheet.iter_pages(
+                PAGE_SIZE, width=len(header[0])
+            ):
+                out.writerows(page)
+                writer.write(buffer.getvalue().encode("utf-8"))
+                buffer.seek(0)
+                buffer.truncate()
+                await writer.drain()
+        writer.write(buffer.getvalue().encode("utf-8"))
+        await writer.drain()
+        logging.info(f"Administration log exported for {nurse_name}")
+
+    async def administrations(self, request, nurse_name, writer):
+        """Give a list of doses, all or none, see run.plan_doses"""
+        payload = request.json()
+        doses = payload.get("doses") if isinstance(payload, dict) else None
+        if not isinstance(doses, list) or not doses:
+            raise HTTPError(400, "Expected {\"doses\": [...]}")
+        records = [
+            (number, dose if isinstance(dose, dict) else {})
+            for number, dose in enumerate(doses, start=1)
+        ]
+        patient_rows, inventory_rows = await asyncio.gather(
+            self.rows("patient_information"), self.rows("inventory")
+        )
+        planned, problems = run.plan_doses(
+            records, run.patients_from_rows(patient_rows),
+            run.medications_from_rows(inventory_rows), label="Dose"
+        )
+        if problems:
+            return 409, {"given": False, "problems": problems}
+        # Stock is written compare-and-set, see transactions.py, so
+        # rounds for different medications don't wait on each other
+        given = await asyncio.to_thread(
+            run.give_medication_round, planned, nurse_name
+        )
+        if not given:
+            return 409, {"given": False,
+                         "problems": ["The inventory changed, try again"]}
+        logging.info(
+            f"{len(planned)} administrations given by {nurse_name} "
+            f"through the API"
+        )
+        return 200, {"given": True, "doses": len(planned)}
+
+
+async def serve_connection(api, reader, writer):
+    try:
+        request = await asyncio.wait_for(
+            read_request(reader), REQUEST_TIMEOUT
+        )
+        if request is not None:
+            peer = writer.get_extra_info("peername")
+            request.client = peer[0] if peer else None
+            await api.handle(request, writer)
+    except HTTPError as e:
+        await send_json(writer, e.status, {"error": e.message})
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+            ConnectionError):
+        pass
+    except Exception as e:
+        logging.error(f"API request failed: {str(e)}")
+        try:
+            await send_json(writer, 500, {"error": "Internal error"})
+        except ConnectionError:
+            pass
+    finally:
+        writer.close()
+
+
+async def serve(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Serve the API until cancelled"""
+    sheets = AsyncSheets(run.WORKSHEETS, run.LOG_WRITER)
+    api = MedicationAPI(sheets)
+    server = await asyncio.start_server(
+        lambda reader, writer: serve_connection(api, reader, writer),
+        host, port
+    )
+    print(f"Serving the medication API on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Medication API server")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args(argv)
+
+    run.STORAGE.start()
+    run.NURSE_ROSTER.load()
+    run.WORKSHEETS.prefetch(run.PREFETCH_SHEETS)
+    run.LOG_WRITER.start()
+    run.TRANSACTIONS.recover()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("\nServer stopped.")
+    finally:
+        run.LOG_WRITER.close()
+        run.TRANSACTIONS.close()
+        run.STORAGE.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,638 @@
+"""
+Google Sheets access for the Medication Administration App.
+
+Nothing here talks to Google when the module is imported. The client is
+authorized and each worksheet is opened the first time it is used, and
+the handles are kept for the rest of the session.
+"""
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import gspread
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from gspread.utils import a1_to_rowcol, numericise_all, rowcol_to_a1
+
+from scheduler import RateLimitedSession
+
+SCOPE = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive.file",
+    "https://www.googleapis.com/auth/drive"
+]
+
+CREDS_FILE = 'creds.json'
+SPREADSHEET_NAME = 'medication_inventory'
+
+WORKSHEET_NAMES = (
+    "nurse_pin",
+    "inventory",
+    "patient_information",
+    "medication_administration_logs",
+    "guidelines"
+)
+
+# Seconds a downloaded sheet is served from memory before it is fetched
+# again. The log sheet is write-mostly and never read from the menus.
+SHEET_TTLS = {
+    "nurse_pin": 600,
+    "inventory": 60,
+    "patient_information": 300,
+    "medication_administration_logs": 0,
+    "guidelines": 3600
+}
+DEFAULT_TTL = 300
+MAX_CACHED_ROWS = 50000
+
+# Keep-alive connections kept open to Google per host
+HTTP_POOL_SIZE = 10
+
+# Threads used to download sheets ahead of the menus
+PREFETCH_WORKERS = 3
+
+# Rows per range read when paging through a sheet with iter_pages
+PAGE_SIZE = 1000
+
+APPENDED_ROW_RE = re.compile(r"![A-Z]+(\d+)")
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Authorize once per process and return the shared gspread client.
+    Its session keeps a pool of open connections, so the credentials are
+    parsed and the TLS handshake is done once rather than per request,
+    and paces and retries requests to stay within the Sheets quota.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            creds = Credentials.from_service_account_file(
+                CREDS_FILE, scopes=SCOPE
+            )
+            session = RateLimitedSession(creds)
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE
+            )
+            session.mount("https://", adapter)
+            _client = gspread.authorize(None, session=session)
+    return _client
+
+
+def cell_text(value):
+    """A value as Sheets shows it back once written"""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    return str(value)
+
+
+def records_from_values(values):
+    """
+    Build get_all_records() style dicts from get_all_values() rows, so a
+    cached download can answer both calls.
+    """
+    if not values:
+        return []
+    header = values[0]
+    records = []
+    for row in values[1:]:
+        row = list(row) + [''] * (len(header) - len(row))
+        records.append(dict(zip(header, numericise_all(row[:len(header)]))))
+    return records
+
+
+class SheetCache:
+    """
+    Read-through store for whole-sheet downloads.
+
+    Each sheet expires after its own TTL. When the cached rows add up to
+    more than max_rows the least recently used sheets are dropped first.
+    """
+    def __init__(
+        self, ttls=None, default_ttl=DEFAULT_TTL, max_rows=MAX_CACHED_ROWS,
+        clock=time.monotonic
+    ):
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self.max_rows = max_rows
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def ttl_for(self, name):
+        return self.ttls.get(name, self.default_ttl)
+
+    def get(self, name):
+        """Return the cached rows for name, or None if absent or expired"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry[0] <= self._clock():
+                self._entries.pop(name, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, name):
+        """Like get, without counting a hit or miss or touching the LRU"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry[0] <= self._clock():
+                return None
+            return entry[1]
+
+    def put(self, name, values):
+        ttl = self.ttl_for(name)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[name] = (self._clock() + ttl, values)
+            self._entries.move_to_end(name)
+            self._evict()
+
+    def invalidate(self, name=None):
+        """Drop one sheet, or everything when no name is given"""
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+    def _evict(self):
+        total = sum(len(values) for _, values in self._entries.values())
+        while total > self.max_rows and len(self._entries) > 1:
+            _, (_, values) = self._entries.popitem(last=False)
+            total -= len(values)
+
+
+def column_letter(col):
+    """Column letters for a 1-based column number, 7 -> 'G'"""
+    return rowcol_to_a1(1, col).rstrip("0123456789")
+
+
+def iter_pages(worksheet, page_size=PAGE_SIZE, first_row=2, width=None):
+    """
+    Yield the rows of a worksheet page_size rows at a time, each page
+    fetched with its own A1 range read, so a sheet of any length is read
+    in constant memory and the first rows can be used while the rest are
+    still to come. Rows are padded to the header width, which is read
+    from row 1 unless given. The cache is not used.
+
+    Sheets leaves blank rows off the end of a range, so a short page
+    doesn't mean the sheet has ended. Pages are read up to the
+    worksheet's row_count, and on while they come back full. Blank rows
+    are yielded once a later row has data, so rows keep their place and
+    the sheet row of each can be counted; blank rows at the very end are
+    not yielded.
+    """
+    if width is None:
+        header = worksheet.get("A1:ZZ1")
+        width = len(header[0]) if header else 0
+    if not width:
+        return
+    last_col = column_letter(width)
+    row_count = getattr(worksheet, "row_count", None) or 0
+    blank = 0
+    while True:
+        last_row = first_row + page_size - 1
+        fetched = worksheet.get(f"A{first_row}:{last_col}{last_row}") or []
+        if fetched:
+            rows = [[''] * width for _ in range(blank)]
+            rows.extend(list(row) + [''] * (width - len(row))
+                        for row in fetched)
+            yield rows
+            blank = page_size - len(fetched)
+        else:
+            blank += page_size
+        if len(fetched) < page_size and last_row >= row_count:
+            return
+        first_row = last_row + 1
+
+
+def iter_rows(worksheet, page_size=PAGE_SIZE, first_row=2, width=None):
+    """Every row from first_row on, read page by page, see iter_pages"""
+    for page in iter_pages(worksheet, page_size, first_row, width):
+        yield from page
+
+
+def appended_row_number(response):
+    """
+    First sheet row written by an append_row/append_rows call, read from
+    the updatedRange of the API response. None if it can't be found.
+    """
+    try:
+        updated_range = response["updates"]["updatedRange"]
+    except (KeyError, TypeError):
+        return None
+    match = APPENDED_ROW_RE.search(updated_range)
+    return int(match.group(1)) if match else None
+
+
+class CellBatch:
+    """
+    Collects cell changes for one worksheet and writes them all with a
+    single batch_update call. Setting the same cell twice keeps the last
+    value. Used as a context manager it flushes on a clean exit and drops
+    the pending changes if the block raised.
+    """
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self._pending = OrderedDict()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def set(self, row, col, value):
+        self._pending[(row, col)] = value
+
+    def flush(self):
+        """Send every pending change in one request"""
+        if not self._pending:
+            return None
+        data = [
+            {"range": rowcol_to_a1(row, col), "values": [[value]]}
+            for (row, col), value in self._pending.items()
+        ]
+        response = self.worksheet.batch_update(data)
+        self._pending.clear()
+        return response
+
+    def discard(self):
+        self._pending.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+        return False
+
+
+class CachedWorksheet:
+    """
+    Wraps a gspread Worksheet so whole-sheet reads go through a
+    SheetCache, other attributes are passed straight to the worksheet.
+
+    Appends and single cell writes made through the wrapper are copied
+    into the cached rows, so the cache and the row indexes stay correct
+    without another download. Any other write invalidates the sheet.
+    """
+    def __init__(self, worksheet, cache, name=None):
+        self.worksheet = worksheet
+        self.cache = cache
+        self.name = name or worksheet.title
+        self._indexes = {}
+        self._derived = {}
+        self._lock = threading.RLock()
+
+    def __getattr__(self, attr):
+        return getattr(self.worksheet, attr)
+
+    def _values(self):
+        values = self.cache.get(self.name)
+        if values is None:
+            # A read that misses while another thread is downloading the
+            # sheet waits for that download instead of starting its own
+            with self._lock:
+                values = self.cache.get(self.name)
+                if values is None:
+                    values = self.worksheet.get_all_values()
+                    self.cache.put(self.name, values)
+        return values
+
+    def get_all_values(self):
+        return list(self._values())
+
+    def reload(self):
+        """Download the sheet again even if it is cached"""
+        with self._lock:
+            values = self.worksheet.get_all_values()
+            self.cache.put(self.name, values)
+            return values
+
+    def get_all_records(self):
+        return records_from_values(self._values())
+
+    def invalidate(self):
+        with self._lock:
+            self.cache.invalidate(self.name)
+            self._indexes.clear()
+            self._derived.clear()
+
+    def row_number(self, key, column=1):
+        """
+        Sheet row whose cell in column (1-based) equals key, or None.
+        The key -> row index is built once per download of the sheet.
+        """
+        with self._lock:
+            values = self._values()
+            entry = self._indexes.get(column)
+            if entry is None or entry[0] is not values:
+                index = {}
+                for row_number, row in enumerate(values[1:], start=2):
+                    if len(row) >= column:
+                        index.setdefault(row[column - 1], row_number)
+                entry = (values, index)
+                self._indexes[column] = entry
+            return entry[1].get(str(key))
+
+    def derived(self, key, build):
+        """
+        build(values) for the sheet's rows, kept until the sheet is
+        downloaded again or written to, so a structure made from the
+        whole sheet is built once rather than on every use.
+        """
+        with self._lock:
+            values = self._values()
+            entry = self._derived.get(key)
+            if entry is None or entry[0] is not values:
+                entry = (values, build(values))
+                self._derived[key] = entry
+            return entry[1]
+
+    def refresh_tail(self):
+        """
+        Fetch only the rows added to the sheet after the cached copy,
+        with one range read, and add them to the cache. Returns the new
+        rows, or None when there is no fresh cached copy to extend and
+        the caller should load the whole sheet instead. Edits to rows
+        already cached show up when the sheet's TTL runs out.
+        """
+        with self._lock:
+            values = self._cached_or_none()
+            if not values:
+                return None
+            width = len(values[0])
+            first_row = len(values) + 1
+            last_col = column_letter(width)
+            fetched = self.worksheet.get(f"A{first_row}:{last_col}")
+            rows = [
+                list(row) + [''] * (width - len(row))
+                for row in fetched or []
+            ]
+            if rows:
+                self._cache_rows(first_row, rows)
+            return rows
+
+    def cached_rows(self, first_row):
+        """Rows from first_row on as last downloaded or written"""
+        return [list(row) for row in self._values()[first_row - 1:]]
+
+    def cached_row(self, row_number):
+        """Row values as last downloaded or written by this process"""
+        values = self._values()
+        if 0 < row_number <= len(values):
+            return list(values[row_number - 1])
+        return []
+
+    def _cached_or_none(self):
+        values = self.cache.get(self.name)
+        if values is None:
+            self._indexes.clear()
+            self._derived.clear()
+        return values
+
+    def _cache_rows(self, first_row, rows):
+        with self._lock:
+            values = self._cached_or_none()
+            if values is None:
+                return
+            if first_row is None or first_row <= len(values):
+                self.invalidate()
+                return
+            if first_row > len(values) + 1 \
+                    and not self._cache_gap(values, first_row):
+                self.invalidate()
+                return
+            self._derived.clear()
+            for offset, row in enumerate(rows):
+                row = [cell_text(value) for value in row]
+                values.append(row)
+                for column, (indexed, index) in self._indexes.items():
+                    if indexed is values and len(row) >= column:
+                        index.setdefault(row[column - 1], first_row + offset)
+
+    def _cache_gap(self, values, first_row):
+        """
+        Another session appended rows after our download and before the
+        rows just written at first_row. Fetch them so the cache stays a
+        copy of the sheet. Returns False if they couldn't all be read.
+        """
+        gap_start = len(values) + 1
+        width = len(values[0]) if values else 0
+        if not width:
+            return False
+        try:
+            fetched = self.worksheet.get(
+                f"A{gap_start}:{column_letter(width)}{first_row - 1}"
+            )
+        except Exception as e:
+            logging.error(f"Could not read new rows of {self.name}: {str(e)}")
+            return False
+        if len(fetched or []) != first_row - gap_start:
+            # Blank rows are trimmed from the response
+            return False
+        self._cache_rows(gap_start, [
+            list(row) + [''] * (width - len(row)) for row in fetched
+        ])
+        return True
+
+    def _cache_cell(self, row_number, column, value):
+        with self._lock:
+            values = self._cached_or_none()
+            if values is None:
+                return
+            if row_number > len(values):
+                self.invalidate()
+                return
+            row = list(values[row_number - 1])
+            row.extend([''] * (column - len(row)))
+            row[column - 1] = cell_text(value)
+            values[row_number - 1] = row
+            self._indexes.pop(column, None)
+            self._derived.clear()
+
+    def append_row(self, values, *args, **kwargs):
+        try:
+            response = self.worksheet.append_row(values, *args, **kwargs)
+        except Exception:
+            self.invalidate()
+            raise
+        self._cache_rows(appended_row_number(response), [values])
+        return response
+
+    def append_rows(self, values, *args, **kwargs):
+        try:
+            response = self.worksheet.append_rows(values, *args, **kwargs)
+        except Exception:
+            self.invalidate()
+            raise
+        self._cache_rows(appended_row_number(response), values)
+        return response
+
+    def update_cell(self, row, col, value):
+        try:
+            response = self.worksheet.update_cell(row, col, value)
+        except Exception:
+            self.invalidate()
+            raise
+        self._cache_cell(row, col, value)
+        return response
+
+    def update(self, *args, **kwargs):
+        try:
+            return self.worksheet.update(*args, **kwargs)
+        finally:
+            self.invalidate()
+
+    def batch_update(self, data, *args, **kwargs):
+        data = list(data)
+        try:
+            response = self.worksheet.batch_update(data, *args, **kwargs)
+        except Exception:
+            self.invalidate()
+            raise
+        for change in data:
+            values = change.get("values") or [[]]
+            if ":" in change["range"] or len(values) != 1 \
+                    or len(values[0]) != 1:
+                self.invalidate()
+                break
+            row, col = a1_to_rowcol(change["range"])
+            self._cache_cell(row, col, values[0][0])
+        return response
+
+    def batch(self):
+        """A CellBatch that writes back through this wrapper"""
+        return CellBatch(self)
+
+
+class WorksheetRegistry:
+    """
+    Lazy mapping of worksheet name to gspread Worksheet.
+
+    The spreadsheet is opened on the first lookup and every worksheet is
+    resolved on its own first lookup, so a session that only logs in and
+    reads the guidelines never opens the inventory or the logs. With a
+    cache the handles are CachedWorksheet wrappers.
+
+    spreadsheet_factory replaces client.open(), for sources such as the
+    local store that aren't opened through a gspread client.
+    """
+    def __init__(
+        self, spreadsheet_name, worksheet_names, client_factory=get_client,
+        cache=None, spreadsheet_factory=None
+    ):
+        self.spreadsheet_name = spreadsheet_name
+        self.worksheet_names = tuple(worksheet_names)
+        self.cache = cache
+        self._client_factory = client_factory
+        self._spreadsheet_factory = spreadsheet_factory
+        self._spreadsheet = None
+        self._handles = {}
+        self._lock = threading.RLock()
+
+    def spreadsheet(self):
+        """Open the spreadsheet on first use"""
+        with self._lock:
+            if self._spreadsheet is None:
+                if self._spreadsheet_factory is not None:
+                    self._spreadsheet = self._spreadsheet_factory()
+                else:
+                    client = self._client_factory()
+                    self._spreadsheet = client.open(self.spreadsheet_name)
+            return self._spreadsheet
+
+    def _wrap(self, name, worksheet):
+        if self.cache is not None:
+            return CachedWorksheet(worksheet, self.cache, name)
+        return worksheet
+
+    def __getitem__(self, name):
+        if name not in self.worksheet_names:
+            raise KeyError(name)
+        with self._lock:
+            handle = self._handles.get(name)
+            if handle is None:
+                handle = self._wrap(name, self.spreadsheet().worksheet(name))
+                self._handles[name] = handle
+            return handle
+
+    def open_all(self, names=None):
+        """
+        Resolve several worksheets at once. A spreadsheet that can list
+        its worksheets is asked once rather than once per name.
+        """
+        names = self.worksheet_names if names is None else names
+        with self._lock:
+            missing = [name for name in names if name not in self._handles]
+            spreadsheet = self.spreadsheet() if missing else None
+            if len(missing) > 1 and hasattr(spreadsheet, "worksheets"):
+                for worksheet in spreadsheet.worksheets():
+                    if worksheet.title in missing:
+                        self._handles[worksheet.title] = self._wrap(
+                            worksheet.title, worksheet
+                        )
+        return [self[name] for name in names]
+
+    def prefetch(self, names, max_workers=PREFETCH_WORKERS, refresh=False):
+        """
+        Download the named sheets into the cache on background threads
+        and return straight away. With refresh, sheets already cached
+        are downloaded again too. Returns the futures, one per sheet; a
+        failed download is logged and the sheet is fetched again when it
+        is first used.
+        """
+        def fetch(name):
+            try:
+                # The first thread in lists the worksheets for them all
+                self.open_all(names)
+                worksheet = self[name]
+                if refresh and hasattr(worksheet, "reload"):
+                    return len(worksheet.reload())
+                return len(worksheet.get_all_values())
+            except Exception as e:
+                logging.error(f"Prefetch of {name} failed: {str(e)}")
+                raise
+
+        executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="prefetch"
+        )
+        futures = [executor.submit(fetch, name) for name in names]
+        executor.shutdown(wait=False)
+        return futures
+
+    def __contains__(self, name):
+        return name in self.worksheet_names
+
+    def __iter__(self):
+        return iter(self.worksheet_names)
+
+    def keys(self):
+        return list(self.worksheet_names)
+
+    def is_open(self, name):
+        """True once the worksheet has been resolved in this session"""
+        return name in self._handles
+
+    def reset(self):
+        """Forget every handle, the next lookup opens them again"""
+        with self._lock:
+            self._spreadsheet = None
+            self._handles.clear()
+            if self.cache is not None:
+                self.cache.invalidate()
@@ -0,0 +1,68 @@
+"""
+On-disk snapshot of the sheet cache.
+
+The patient, inventory and guidelines sheets are saved with marshal
+when a session ends. The next start loads them back into the SheetCache
+before login, which takes milliseconds rather than a round of downloads,
+and the background prefetch then replaces them with fresh copies. A
+snapshot is only used by the same backend and spreadsheet that wrote it
+and only while it is younger than SNAPSHOT_MAX_AGE. It holds patient
+details, so the file is only readable by its owner.
+"""
+import logging
+import marshal
+import os
+import time
+
+SNAPSHOT_FILE = '.sheet_snapshot'
+SNAPSHOT_MAX_AGE = 24 * 60 * 60
+SNAPSHOT_FORMAT = 1
+
+
+def save_snapshot(cache, names, source, path=SNAPSHOT_FILE):
+    """
+    Write the cached rows of the named sheets, those that are cached.
+    Returns the number of sheets saved.
+    """
+    sheets = {}
+    for name in names:
+        values = cache.peek(name)
+        if values is not None:
+            sheets[name] = [list(row) for row in values]
+    if not sheets:
+        return 0
+    data = marshal.dumps((SNAPSHOT_FORMAT, source, time.time(), sheets))
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as snapshot:
+        snapshot.write(data)
+    os.replace(tmp_path, path)
+    return len(sheets)
+
+
+def load_snapshot(cache, names, source, path=SNAPSHOT_FILE,
+                  max_age=SNAPSHOT_MAX_AGE, clock=time.time):
+    """
+    Put the named sheets from the snapshot into the cache. Returns the
+    names loaded, none if the file is missing, unreadable, too old or
+    from another source.
+    """
+    try:
+        with open(path, 'rb') as snapshot:
+            version, saved_by, saved_at, sheets = marshal.loads(
+                snapshot.read()
+            )
+    except FileNotFoundError:
+        return []
+    except (OSError, EOFError, ValueError, TypeError) as e:
+        logging.error(f"Ignoring unreadable sheet snapshot: {str(e)}")
+        return []
+    if version != SNAPSHOT_FORMAT or saved_by != source \
+            or clock() - saved_at > max_age:
+        return []
+    loaded = []
+    for name in names:
+        if name in sheets:
+            cache.put(name, sheets[name])
+            loaded.append(name)
+    return loaded
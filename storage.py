@@ -0,0 +1,165 @@
+"""
+Storage backends for the medication_inventory worksheets.
+
+A backend's open() returns a spreadsheet-like object whose worksheet(name)
+hands out worksheets answering the calls the app makes:
+get_all_values, get_all_records, append_row, append_rows, update,
+update_cell and batch_update.
+
+- GspreadBackend talks to Google Sheets.
+- MemoryBackend keeps everything in memory, for tests and benchmarks.
+- SQLiteBackend serves a local SQLite copy and, given an upstream
+  backend, syncs its journal to it in the background.
+
+get_backend() picks one from the MEDAPP_BACKEND environment variable.
+"""
+import json
+import logging
+import os
+
+from local_store import LOCAL_STORE_FILE, LocalStore, SyncWorker
+from memory_sheets import MemorySpreadsheet
+from scheduler import REQUEST_METRICS
+from sheets import SPREADSHEET_NAME, WORKSHEET_NAMES, get_client
+
+BACKEND_ENV = "MEDAPP_BACKEND"
+SEED_ENV = "MEDAPP_SEED"
+
+# Header rows for a blank in-memory spreadsheet
+EMPTY_SHEETS = {
+    "nurse_pin": [["nurse_name", "nurse_pin"]],
+    "inventory": [[
+        "Medication name", "Strength", "Form", "Quantity in stock",
+        "Reorder level", "Last ordered date", "In stock"
+    ]],
+    "patient_information": [[
+        "Patient ID", "Name", "Surname", "Date of birth", "Room"
+    ]],
+    "medication_administration_logs": [[
+        "Date", "Patient surname", "Patient name", "Medication",
+        "Quantity", "Strength", "Nurse"
+    ]],
+    "guidelines": [[
+        "Medication name", "Administration guidelines", "Dosage guidelines",
+        "Intervals", "Potential side effects", "Emergency procedures",
+        "Additional notes"
+    ]]
+}
+
+
+class StorageBackend:
+    """Base class for the places the worksheets can live"""
+    name = None
+
+    def __init__(self, spreadsheet_name=SPREADSHEET_NAME):
+        self.spreadsheet_name = spreadsheet_name
+
+    def open(self):
+        """Return the spreadsheet-like object for this backend"""
+        raise NotImplementedError
+
+    def worksheet(self, name):
+        return self.open().worksheet(name)
+
+    def start(self):
+        """Called once before the app uses the backend"""
+
+    def stop(self):
+        """Called once when the app is done with the backend"""
+
+
+class GspreadBackend(StorageBackend):
+    """Google Sheets through an authorized gspread client"""
+    name = "gspread"
+
+    def __init__(
+        self, spreadsheet_name=SPREADSHEET_NAME, client_factory=get_client
+    ):
+        super().__init__(spreadsheet_name)
+        self.client_factory = client_factory
+        self._spreadsheet = None
+
+    def open(self):
+        if self._spreadsheet is None:
+            client = self.client_factory()
+            self._spreadsheet = client.open(self.spreadsheet_name)
+        return self._spreadsheet
+
+    def stop(self):
+        if REQUEST_METRICS.requests:
+            logging.info(REQUEST_METRICS.summary())
+
+
+class MemoryBackend(StorageBackend):
+    """Worksheets held in memory, seeded from a dict of sheet rows"""
+    name = "memory"
+
+    def __init__(self, sheets=None, spreadsheet_name=SPREADSHEET_NAME):
+        super().__init__(spreadsheet_name)
+        if sheets is None:
+            sheets = EMPTY_SHEETS
+        self.spreadsheet = MemorySpreadsheet(spreadsheet_name, {
+            name: [list(row) for row in rows] for name, rows in sheets.items()
+        })
+
+    @classmethod
+    def from_json(cls, path, spreadsheet_name=SPREADSHEET_NAME):
+        """Seed from a JSON file mapping sheet name to a list of rows"""
+        with open(path, encoding='utf-8') as seed:
+            return cls(json.load(seed), spreadsheet_name)
+
+    def open(self):
+        return self.spreadsheet
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    A local SQLite copy of the worksheets. With an upstream backend the
+    copy is filled from it on start and changes are synced back to it.
+    """
+    name = "sqlite"
+
+    def __init__(
+        self, path=LOCAL_STORE_FILE, upstream=None,
+        spreadsheet_name=SPREADSHEET_NAME
+    ):
+        super().__init__(spreadsheet_name)
+        self.store = LocalStore(path, spreadsheet_name)
+        self.upstream = upstream
+        self.sync_worker = None
+        if upstream is not None:
+            self.sync_worker = SyncWorker(
+                self.store, upstream.open, WORKSHEET_NAMES
+            )
+
+    def open(self):
+        return self.store
+
+    def start(self):
+        if self.sync_worker is not None:
+            self.sync_worker.start()
+
+    def stop(self):
+        if self.sync_worker is not None:
+            self.sync_worker.stop()
+
+
+def get_backend(kind=None):
+    """
+    Build the backend named by kind or MEDAPP_BACKEND: gspread (the
+    default), memory or sqlite. MEDAPP_OFFLINE=1 is kept as a shorthand
+    for sqlite. The memory backend is seeded from MEDAPP_SEED if set.
+    """
+    if kind is None:
+        kind = os.environ.get(BACKEND_ENV)
+    if kind is None and os.environ.get("MEDAPP_OFFLINE") == "1":
+        kind = SQLiteBackend.name
+    kind = kind or GspreadBackend.name
+    if kind == GspreadBackend.name:
+        return GspreadBackend()
+    if kind == MemoryBackend.name:
+        seed = os.environ.get(SEED_ENV)
+        return MemoryBackend.from_json(seed) if seed else MemoryBackend()
+    if kind == SQLiteBackend.name:
+        return SQLiteBackend(upstream=GspreadBackend())
+    raise ValueError(f"Unknown storage backend: {kind}")
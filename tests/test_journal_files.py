@@ -0,0 +1,53 @@
+"""Per-process journal files"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import journal_files  # noqa: E402
+
+BASE = 'test.journal'
+
+
+class JournalFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        self.addCleanup(self.directory.cleanup)
+        self.addCleanup(os.chdir, self.cwd)
+
+    def open_own(self):
+        path, journal = journal_files.open_own(BASE)
+        self.addCleanup(journal.close)
+        return path, journal
+
+    def test_busy_lists_only_live_journals_with_entries(self):
+        own_path, own = self.open_own()
+        journal_files.append(own, [["mine"]])
+        live_path, live = self.open_own()
+        journal_files.append(live, [["row"]])
+        self.open_own()
+        with open(BASE + '.1-dead', 'w') as orphan:
+            orphan.write('["row"]\n')
+        self.assertEqual(journal_files.busy(BASE, own_path), [live_path])
+        journal_files.clear(live)
+        self.assertEqual(journal_files.busy(BASE, own_path), [])
+
+    def test_orphans_skips_live_journals(self):
+        own_path, _ = self.open_own()
+        self.open_own()
+        with open(BASE + '.1-dead', 'w') as orphan:
+            orphan.write('["row"]\n')
+        adopted = []
+        for path, journal in journal_files.orphans(BASE, own_path):
+            adopted.append((path, list(journal_files.entries(journal))))
+            journal_files.discard(path, journal)
+        self.assertEqual(adopted, [(BASE + '.1-dead', [["row"]])])
+        self.assertFalse(os.path.exists(BASE + '.1-dead'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""AdministrationLogWriter journals against the in-memory backend"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from log_writer import (  # noqa: E402
+    LOG_JOURNAL_FILE, AdministrationLogWriter, unsent_rows
+)
+from memory_sheets import MemoryWorksheet  # noqa: E402
+
+
+class FailingWorksheet:
+    def append_rows(self, rows):
+        raise ConnectionError("lost")
+
+
+class LogWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        self.addCleanup(self.directory.cleanup)
+        self.addCleanup(os.chdir, self.cwd)
+        self.log = MemoryWorksheet('log', [['Medication', 'Quantity']])
+
+    def writer(self, worksheet):
+        writer = AdministrationLogWriter(lambda: worksheet)
+        self.addCleanup(self.release, writer)
+        return writer
+
+    def release(self, writer):
+        if writer._journal is not None:
+            writer._journal.close()
+
+    def logged(self):
+        return self.log.get_all_values()[1:]
+
+    def test_unsent_rows_skips_rows_marked_sent(self):
+        self.assertEqual(unsent_rows([
+            ['a'], ['b'], {"sent": 1}, ['c'], {"sent": 2}, ['d'],
+        ]), [['d']])
+        self.assertEqual(unsent_rows([['a'], ['b']]), [['a'], ['b']])
+
+    def test_flush_sends_and_empties_journal(self):
+        writer = self.writer(self.log)
+        writer.write_rows([['Morphine', 2], ['Oxycodone', 1]])
+        self.assertTrue(writer.flush())
+        self.assertEqual(self.logged(), [
+            ['Morphine', '2'], ['Oxycodone', '1']
+        ])
+        self.assertEqual(os.path.getsize(writer.journal_path), 0)
+        writer.close()
+        self.assertFalse(os.path.exists(writer.journal_path))
+
+    def test_failed_flush_keeps_rows(self):
+        writer = self.writer(FailingWorksheet())
+        writer.write(['Morphine', 2])
+        with self.assertLogs(level='ERROR'):
+            self.assertFalse(writer.flush())
+            self.assertEqual(writer.pending, 1)
+            writer.close()
+        self.assertTrue(os.path.exists(writer.journal_path))
+
+    def test_adopts_unsent_rows_of_orphaned_journal(self):
+        path = LOG_JOURNAL_FILE + '.1-dead'
+        with open(path, 'w') as journal:
+            for entry in [['Morphine', '2'], {"sent": 1}, ['Oxycodone', '1']]:
+                journal.write(json.dumps(entry) + '\n')
+        writer = self.writer(self.log)
+        self.assertTrue(writer.flush())
+        self.assertEqual(self.logged(), [['Oxycodone', '1']])
+        self.assertFalse(os.path.exists(path))
+
+    def test_live_journal_is_not_adopted(self):
+        owner = self.writer(FailingWorksheet())
+        owner.write(['Morphine', '2'])
+        with self.assertLogs(level='ERROR'):
+            owner.flush()
+        other = self.writer(self.log)
+        other.flush()
+        self.assertEqual(self.logged(), [])
+        self.assertTrue(os.path.exists(owner.journal_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
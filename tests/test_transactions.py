@@ -0,0 +1,243 @@
+"""
+Administration transactions against the in-memory backend.
+
+Each session gets its own SheetCache, journal and log writer, as a
+separate copy of the app would. flock treats every open of a file as a
+different holder, so sessions in one process lock each other out like
+processes do.
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import transactions  # noqa: E402
+from log_writer import AdministrationLogWriter  # noqa: E402
+from memory_sheets import MemoryWorksheet  # noqa: E402
+from sheets import CachedWorksheet, SheetCache  # noqa: E402
+from transactions import (  # noqa: E402
+    APPLIED, APPLYING, STAGED, StockChange, StockConflict,
+    TransactionJournal, replay
+)
+
+QUANTITY = 4
+HEADER = ['Medication Name', 'Strength', 'Form', 'Quantity in Stock']
+
+
+class Session:
+    """One nurse's copy of the app over the shared worksheets"""
+    def __init__(self, inventory, log):
+        cache = SheetCache({inventory.title: 600, log.title: 600})
+        self.inventory = CachedWorksheet(inventory, cache)
+        self.log = CachedWorksheet(log, cache)
+        self.log_writer = AdministrationLogWriter(lambda: self.log)
+        self.transactions = TransactionJournal(
+            lambda: self.inventory, self.log_writer
+        )
+
+    def close(self):
+        """Let go of the journals, as a process does when it dies"""
+        for journal in (self.log_writer._journal,
+                        self.transactions._journal):
+            if journal is not None:
+                journal.close()
+
+    def stock(self, name):
+        row = self.inventory.row_number(name)
+        return int(self.inventory.cached_row(row)[QUANTITY - 1])
+
+    def give(self, name, quantity):
+        """Commit a dose planned from the stock this session last saw"""
+        old = self.stock(name)
+        change = StockChange(name, QUANTITY, old, old - quantity)
+        self.transactions.commit([change], [[name, str(quantity)]])
+        return change
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        self.addCleanup(self.directory.cleanup)
+        self.addCleanup(os.chdir, self.cwd)
+        self.inventory = MemoryWorksheet('inventory', [
+            HEADER,
+            ['Paracetamol', '500mg', 'tablet', '20'],
+            ['Morphine', '10mg', 'tablet', '10'],
+            ['Oxycodone', '5mg', 'tablet', '5'],
+        ])
+        self.log = MemoryWorksheet('log', [['Medication', 'Quantity']])
+
+    def session(self):
+        session = Session(self.inventory, self.log)
+        session.inventory.get_all_values()
+        self.addCleanup(session.close)
+        return session
+
+    def sheet_stock(self, name):
+        for row in self.inventory.get_all_values():
+            if row[0] == name:
+                return int(row[QUANTITY - 1])
+
+    def logged(self):
+        return self.log.get_all_values()[1:]
+
+    def journal_paths(self):
+        return sorted(
+            name for name in os.listdir('.')
+            if name.startswith(transactions.TRANSACTION_JOURNAL_FILE)
+        )
+
+    def test_commit_takes_stock_and_queues_rows(self):
+        session = self.session()
+        session.give('Morphine', 2)
+        session.log_writer.flush()
+        self.assertEqual(self.sheet_stock('Morphine'), 8)
+        self.assertEqual(self.logged(), [['Morphine', '2']])
+        self.assertEqual(session.transactions.pending, 0)
+
+    def test_rebases_onto_stock_changed_by_another_session(self):
+        session = self.session()
+        self.inventory.update_cell(3, QUANTITY, 7)
+        change = session.give('Morphine', 2)
+        self.assertEqual((change.old, change.new), (7, 5))
+        self.assertEqual(self.sheet_stock('Morphine'), 5)
+
+    def test_refuses_when_fresh_stock_cannot_cover(self):
+        session = self.session()
+        self.inventory.update_cell(3, QUANTITY, 1)
+        with self.assertRaises(StockConflict):
+            session.give('Morphine', 2)
+        session.log_writer.flush()
+        self.assertEqual(self.sheet_stock('Morphine'), 1)
+        self.assertEqual(self.logged(), [])
+        self.assertEqual(session.transactions.pending, 0)
+
+    def test_row_moved_by_deletion_above(self):
+        session = self.session()
+        del self.inventory._rows[1]
+        session.give('Morphine', 1)
+        self.assertEqual(self.sheet_stock('Morphine'), 9)
+        self.assertEqual(self.sheet_stock('Oxycodone'), 5)
+
+    def test_concurrent_sessions_take_every_dose(self):
+        sessions = [self.session() for _ in range(8)]
+        self.inventory.update_cell(3, QUANTITY, 100)
+        errors = []
+
+        def give_doses(session):
+            try:
+                for _ in range(10):
+                    session.give('Morphine', 1)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=give_doses, args=(session,))
+            for session in sessions
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for session in sessions:
+            session.log_writer.flush()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.sheet_stock('Morphine'), 20)
+        self.assertEqual(len(self.logged()), 80)
+
+    def test_recover_staged_rebases_stale_figure(self):
+        session = self.session()
+        self.inventory.update_cell(3, QUANTITY, 9)
+        get = self.inventory.get
+
+        def lost_connection(*args, **kwargs):
+            self.inventory.get = get
+            raise ConnectionError("lost")
+
+        self.inventory.get = lost_connection
+        with self.assertRaises(ConnectionError):
+            session.give('Morphine', 2)
+        # The stock figure staged is the 10 the session had cached
+        self.assertEqual(session.transactions.pending, 1)
+        self.assertEqual(session.transactions.recover(), 1)
+        session.log_writer.flush()
+        self.assertEqual(self.sheet_stock('Morphine'), 7)
+        self.assertEqual(self.logged(), [['Morphine', '2']])
+
+    def write_orphan(self, state, old, new):
+        path = transactions.TRANSACTION_JOURNAL_FILE + '.1-dead'
+        with open(path, 'w') as journal:
+            journal.write(json.dumps({
+                "id": "t1", "state": state,
+                "changes": [['Morphine', QUANTITY, old, new]],
+                "log_rows": [['Morphine', str(old - new)]],
+            }) + '\n')
+        return path
+
+    def test_adopts_orphaned_staged_journal(self):
+        path = self.write_orphan(STAGED, 10, 8)
+        self.inventory.update_cell(3, QUANTITY, 6)
+        session = self.session()
+        self.assertEqual(session.transactions.recover(), 1)
+        session.log_writer.flush()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.sheet_stock('Morphine'), 4)
+        self.assertEqual(self.logged(), [['Morphine', '2']])
+
+    def test_recover_applying_redoes_when_cell_holds_old(self):
+        self.write_orphan(APPLYING, 10, 8)
+        session = self.session()
+        self.assertEqual(session.transactions.recover(), 1)
+        self.assertEqual(self.sheet_stock('Morphine'), 8)
+
+    def test_recover_applying_keeps_a_write_that_landed(self):
+        self.write_orphan(APPLYING, 12, 10)
+        session = self.session()
+        self.assertEqual(session.transactions.recover(), 1)
+        session.log_writer.flush()
+        self.assertEqual(self.sheet_stock('Morphine'), 10)
+        self.assertEqual(self.logged(), [['Morphine', '2']])
+
+    def test_recover_applied_only_logs(self):
+        self.write_orphan(APPLIED, 10, 8)
+        session = self.session()
+        self.assertEqual(session.transactions.recover(), 1)
+        session.log_writer.flush()
+        self.assertEqual(self.sheet_stock('Morphine'), 10)
+        self.assertEqual(self.logged(), [['Morphine', '2']])
+
+    def test_live_journal_is_not_adopted(self):
+        owner = self.session()
+        owner.transactions.stage(
+            [StockChange('Morphine', QUANTITY, 10, 8)], [['Morphine', '2']]
+        )
+        owner.transactions._release(next(iter(owner.transactions._active)))
+        other = self.session()
+        self.assertEqual(other.transactions.recover(), 0)
+        self.assertIn(os.path.basename(owner.transactions.path),
+                      self.journal_paths())
+        self.assertEqual(self.sheet_stock('Morphine'), 10)
+        self.assertEqual(owner.transactions.recover(), 1)
+        self.assertEqual(self.sheet_stock('Morphine'), 8)
+
+    def test_replay_reads_old_single_object_journal_as_applying(self):
+        transactions_left = replay([
+            {"t1": {"state": STAGED, "changes": [], "log_rows": []}},
+            {"id": "t2", "state": STAGED, "changes": [], "log_rows": []},
+            {"id": "t3", "state": STAGED, "changes": [], "log_rows": []},
+            {"id": "t3", "done": True},
+        ])
+        self.assertEqual(
+            {key: value["state"] for key, value in transactions_left.items()},
+            {"t1": APPLYING, "t2": STAGED}
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,427 @@
+"""
+Administration transactions.
+
+Giving medication makes two writes: new stock levels on the inventory
+sheet and rows on the administration log. A failure between them used
+to leave stock taken with no record of who it went to. Here both are
+staged in a local journal first and applied in two phases:
+
+1. the transaction is marked as applying, the stock cells are set in
+   one batch_update, then it is marked as applied;
+2. the log rows are handed to the AdministrationLogWriter, whose own
+   journal keeps them until Google accepts them, and the transaction is
+   removed.
+
+Stock is written compare-and-set. Just before the write each stock cell
+is read fresh from the sheet, together with the medication name at the
+start of its row, so a row added or deleted above it since the download
+is noticed and the row looked up again. If another session has changed
+the stock since the app last saw it, the change is rebased onto the new
+figure, taking the same quantity, and checked again. The read and the
+write happen under a lock per medication: a thread lock, and an flock on
+the medication's administration_stock.<hash>.lock file, which every copy
+of the app in the same directory takes. So two nurses' sessions never
+interleave on one medication's stock, and administrations of other
+medications carry on in parallel. Edits made straight on the sheet, or
+by a copy of the app running elsewhere, are not covered by the lock.
+
+recover() finishes whatever a crash or lost connection interrupted. A
+transaction still staged never reached the write, so it goes through
+the compare-and-set like a new one. One left applying may or may not
+have landed: it is applied again only if the cell still holds the value
+it had before. Otherwise it is reported, and the reconcile command
+shows any difference left in the stock.
+
+Each process keeps its own journal, see journal_files.py. recover()
+also takes over the journals of processes that are gone, never those
+of one still running. The journal is a list of events, a transaction
+staged, its changes rebased, its state moved on or it being done, and
+is emptied whenever no transaction is left.
+"""
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from contextlib import ExitStack
+
+import journal_files
+from sheets import cell_text, column_letter
+
+TRANSACTION_JOURNAL_FILE = 'administration_transactions.json'
+STOCK_LOCK_FILE = 'administration_stock.{}.lock'
+
+STAGED = 'staged'
+APPLYING = 'applying'
+APPLIED = 'applied'
+
+# Fresh reads of a stock cell before giving up on it changing under us
+CAS_ATTEMPTS = 5
+CAS_RETRY_DELAY = 0.2
+
+
+class StockConflict(Exception):
+    """The stock changed and can no longer cover the administration"""
+
+
+class StockChange:
+    """Set column of the named medication's row from old to new"""
+    __slots__ = ('medication_name', 'column', 'old', 'new')
+
+    def __init__(self, medication_name, column, old, new):
+        self.medication_name = medication_name
+        self.column = column
+        self.old = old
+        self.new = new
+
+    def as_list(self):
+        return [self.medication_name, self.column, self.old, self.new]
+
+
+def replay(entries):
+    """Transactions left by a journal's events, by id"""
+    transactions = {}
+    for entry in entries:
+        if "id" not in entry:
+            # Older versions kept the whole journal as one object, and
+            # marked nothing before the write, so a staged transaction
+            # of theirs may have been applied
+            for transaction_id, transaction in entry.items():
+                if transaction.get("state") == STAGED:
+                    transaction = dict(transaction, state=APPLYING)
+                transactions[transaction_id] = transaction
+        elif entry.get("done"):
+            transactions.pop(entry["id"], None)
+        else:
+            transactions.setdefault(entry["id"], {}).update(
+                (key, value) for key, value in entry.items() if key != "id"
+            )
+    return transactions
+
+
+class TransactionJournal:
+    """
+    Stages stock changes and log rows and applies them as one unit.
+
+    inventory_factory returns the (cached) inventory worksheet and
+    log_writer is the AdministrationLogWriter the rows are queued on.
+    """
+    def __init__(self, inventory_factory, log_writer,
+                 path=TRANSACTION_JOURNAL_FILE, lock_path=STOCK_LOCK_FILE):
+        self.inventory_factory = inventory_factory
+        self.log_writer = log_writer
+        self.base_path = path
+        self.lock_path = lock_path
+        self.path = None
+        self._journal = None
+        self._lock = threading.RLock()
+        self._transactions = {}
+        self._active = set()
+        self._key_locks = {}
+
+    def _open_journal(self):
+        """
+        Create this process's journal on first use and take over the
+        transactions of processes that stopped. Called with the lock.
+        """
+        if self._journal is not None:
+            return
+        self.path, self._journal = journal_files.open_own(self.base_path)
+        for path, orphan in journal_files.orphans(self.base_path, self.path):
+            adopted = replay(journal_files.entries(orphan))
+            journal_files.append(self._journal, [
+                dict(transaction, id=transaction_id)
+                for transaction_id, transaction in adopted.items()
+            ])
+            self._transactions.update(adopted)
+            journal_files.discard(path, orphan)
+            if adopted:
+                logging.info(
+                    f"Took over {len(adopted)} transactions from {path}"
+                )
+
+    def _record(self, entry):
+        with self._lock:
+            self._open_journal()
+            journal_files.append(self._journal, [entry])
+
+    def close(self):
+        """Delete this process's journal if nothing is left in it"""
+        with self._lock:
+            if self._journal is not None and not self._transactions:
+                journal_files.discard(self.path, self._journal)
+                self._journal = None
+
+    @property
+    def pending(self):
+        """Transactions left unfinished, not counting ones in progress"""
+        with self._lock:
+            return len(self._transactions) - len(self._active)
+
+    def _stock_lock_path(self, name):
+        key = hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+        return self.lock_path.format(key)
+
+    def _locked(self, names):
+        """
+        Hold the per-medication locks, always taken in name order. The
+        thread lock orders this process's threads, the flock on the
+        medication's lock file other processes.
+        """
+        names = sorted(set(names))
+        with self._lock:
+            locks = [
+                self._key_locks.setdefault(name, threading.Lock())
+                for name in names
+            ]
+        stack = ExitStack()
+        try:
+            for name, lock in zip(names, locks):
+                stack.enter_context(lock)
+                stack.enter_context(
+                    journal_files.file_lock(self._stock_lock_path(name))
+                )
+        except BaseException:
+            stack.close()
+            raise
+        return stack
+
+    def stage(self, changes, log_rows):
+        """
+        Write a transaction to the journal, returns its id. It is staged
+        as in progress, so recover() leaves it to the caller until
+        _release() is called, normally at the end of commit().
+        """
+        transaction_id = uuid.uuid4().hex
+        transaction = {
+            "state": STAGED,
+            "changes": [change.as_list() for change in changes],
+            "log_rows": [[str(value) for value in row] for row in log_rows],
+        }
+        with self._lock:
+            self._record(dict(transaction, id=transaction_id))
+            self._transactions[transaction_id] = transaction
+            self._active.add(transaction_id)
+        return transaction_id
+
+    def _release(self, transaction_id):
+        with self._lock:
+            self._active.discard(transaction_id)
+
+    def _set_state(self, transaction_id, state):
+        with self._lock:
+            self._record({"id": transaction_id, "state": state})
+            self._transactions[transaction_id]["state"] = state
+
+    def _set_changes(self, transaction_id, changes):
+        changes = [change.as_list() for change in changes]
+        with self._lock:
+            self._record({"id": transaction_id, "changes": changes})
+            self._transactions[transaction_id]["changes"] = changes
+
+    def _finish(self, transaction_id):
+        with self._lock:
+            transaction = self._transactions[transaction_id]
+            self.log_writer.write_rows(transaction["log_rows"])
+            self._drop(transaction_id)
+
+    def _drop(self, transaction_id):
+        with self._lock:
+            del self._transactions[transaction_id]
+            if self._transactions:
+                self._record({"id": transaction_id, "done": True})
+            else:
+                journal_files.clear(self._journal)
+
+    def _read_stock(self, inventory, name, column):
+        """
+        The named medication's row and its cell in column, read fresh
+        from the sheet along with the name in column A. If rows were
+        added or deleted above it since the download, so the name no
+        longer matches, the sheet is downloaded again and the row looked
+        up afresh.
+        """
+        for attempt in range(2):
+            row = inventory.row_number(name)
+            if row is None:
+                break
+            fresh = inventory.get(f"A{row}:{column_letter(column)}{row}")
+            cells = fresh[0] if fresh else []
+            if cells and cells[0] == name:
+                return row, cells[column - 1] if len(cells) >= column else ''
+            logging.info(f"{name} is no longer on row {row}, reloading")
+            inventory.invalidate()
+        raise StockConflict(f"{name} is not in the inventory")
+
+    def _rebase(self, inventory, changes):
+        """
+        Compare each change's old value with the cell as it is now. A
+        change whose cell moved is recomputed from the fresh figure and
+        everything is read again, until a read finds nothing moved.
+        Returns True if any change was rebased.
+        """
+        rebased = False
+        for attempt in range(CAS_ATTEMPTS):
+            moved = []
+            for change in changes:
+                _, current = self._read_stock(
+                    inventory, change.medication_name, change.column
+                )
+                if current != cell_text(change.old):
+                    moved.append((change, current))
+            if not moved:
+                return rebased
+            for change, current in moved:
+                taken = change.old - change.new
+                try:
+                    current = int(current)
+                except ValueError:
+                    raise StockConflict(
+                        f"Invalid quantity in stock for "
+                        f"{change.medication_name}"
+                    )
+                if current < taken:
+                    raise StockConflict(
+                        f"Not enough {change.medication_name} in stock, "
+                        f"another session left {current}"
+                    )
+                logging.info(
+                    f"Stock of {change.medication_name} changed from "
+                    f"{change.old} to {current}, rebasing"
+                )
+                change.old, change.new = current, current - taken
+            rebased = True
+            time.sleep(CAS_RETRY_DELAY * attempt)
+        raise StockConflict("The stock kept changing, please try again")
+
+    def _apply_changes(self, changes):
+        inventory = self.inventory_factory()
+        with inventory.batch() as batch:
+            for name, column, _, new in changes:
+                row = inventory.row_number(name)
+                if row is None:
+                    raise KeyError(f"{name} is not in the inventory")
+                batch.set(row, column, new)
+
+    def commit(self, changes, log_rows):
+        """
+        Stage, then apply both phases, the stock compare-and-set. The
+        StockChange objects are updated if they had to be rebased.
+        StockConflict means nothing was written. After any other error
+        the transaction stays in the journal for recover() and the error
+        is raised.
+        """
+        transaction_id = self.stage(changes, log_rows)
+        try:
+            inventory = self.inventory_factory()
+            names = [change.medication_name for change in changes]
+            with self._locked(names):
+                try:
+                    if self._rebase(inventory, changes):
+                        self._set_changes(transaction_id, changes)
+                except StockConflict:
+                    self._drop(transaction_id)
+                    raise
+                self._set_state(transaction_id, APPLYING)
+                self._apply_changes([change.as_list() for change in changes])
+            self._set_state(transaction_id, APPLIED)
+            self._finish(transaction_id)
+        finally:
+            self._release(transaction_id)
+        return transaction_id
+
+    def recover(self):
+        """
+        Complete every transaction left in the journal. Returns the
+        number completed; any that still can't be applied are kept.
+        Each is claimed first, and ones being committed or recovered by
+        another thread are skipped.
+        """
+        with self._lock:
+            self._open_journal()
+            waiting = [
+                (transaction_id, transaction)
+                for transaction_id, transaction in self._transactions.items()
+                if transaction_id not in self._active
+            ]
+            self._active.update(
+                transaction_id for transaction_id, _ in waiting
+            )
+        if not waiting:
+            return 0
+        completed = 0
+        try:
+            inventory = self.inventory_factory()
+            inventory.invalidate()
+            for transaction_id, transaction in waiting:
+                completed += self._recover_one(
+                    inventory, transaction_id, transaction
+                )
+        finally:
+            for transaction_id, _ in waiting:
+                self._release(transaction_id)
+        if completed:
+            logging.info(f"Recovered {completed} administration transactions")
+        return completed
+
+    def _recover_one(self, inventory, transaction_id, transaction):
+        """Complete one claimed transaction, returns 1 if it was"""
+        try:
+            if transaction["state"] == STAGED:
+                if not self._recover_staged(inventory, transaction_id,
+                                            transaction):
+                    return 0
+            elif transaction["state"] == APPLYING:
+                self._recover_changes(inventory, transaction["changes"])
+            if transaction["state"] != APPLIED:
+                self._set_state(transaction_id, APPLIED)
+            self._finish(transaction_id)
+            return 1
+        except Exception as e:
+            logging.error(
+                f"Could not recover transaction {transaction_id}: {str(e)}"
+            )
+            return 0
+
+    def _recover_staged(self, inventory, transaction_id, transaction):
+        """
+        Apply a transaction that never reached the write, rebased on the
+        stock as it is now. Returns False if the stock can no longer
+        cover it, in which case it is dropped and its rows are logged.
+        """
+        changes = [StockChange(*change) for change in transaction["changes"]]
+        with self._locked(change.medication_name for change in changes):
+            try:
+                if self._rebase(inventory, changes):
+                    self._set_changes(transaction_id, changes)
+            except StockConflict as e:
+                logging.error(
+                    f"Dropped transaction {transaction_id}: {str(e)}; "
+                    f"not logged: {transaction['log_rows']}"
+                )
+                self._drop(transaction_id)
+                return False
+            self._set_state(transaction_id, APPLYING)
+            self._apply_changes(transaction["changes"])
+        return True
+
+    def _recover_changes(self, inventory, changes):
+        with self._locked(change[0] for change in changes):
+            redo = []
+            for change in changes:
+                name, column, old, new = change
+                try:
+                    _, current = self._read_stock(inventory, name, column)
+                except StockConflict:
+                    current = None
+                if current == cell_text(new):
+                    continue
+                if current == cell_text(old):
+                    redo.append(change)
+                    continue
+                logging.error(
+                    f"Stock of {name} is {current}, expected {old} or {new}; "
+                    f"left for reconciliation"
+                )
+            if redo:
+                self._apply_changes(redo)